@@ -1,14 +1,16 @@
 import os
 from optparse import OptionParser
 
-import yaml
-
 import density_functional_approximation_dm21 as dm21
+from benchmark_store import build_store, reactions
+from density_functional_approximation_dm21.constants import HARTREE_TO_KCAL
+from results_db import read_energies
 
 omega_str_list = ["0", "0076", "067", "18", "33", "50", "67", "82", "93", "99", "100"]
 
 func_dict = [f"NN_PBE_{omega}" for omega in omega_str_list]
 func_dict.extend([f"NN_XALPHA_{omega}" for omega in omega_str_list])
+non_nn_functionals = ["PBE", "XAlpha", "r2SCAN"]
 
 parser = OptionParser()
 parser.add_option("--NFinal", type=int, default=30, help="Number systems to select")
@@ -16,6 +18,21 @@ parser.add_option("--Mode", type="string", default="Analyse", help="Mode")
 parser.add_option(
     "--Functional", type="string", default="NN_PBE_0", help="Functional to evaluate"
 )
+parser.add_option(
+    "--Executor",
+    type="string",
+    default="slurm",
+    help="CE mode: slurm (one sbatch job per system) or local (process pool)",
+)
+parser.add_option(
+    "--Workers",
+    type=int,
+    default=None,
+    help="Processes of the local executor (default: CPUs allotted to the job)",
+)
+parser.add_option(
+    "--LogDir", type="string", default="log_files", help="Job logs folder"
+)
 
 (Opts, args) = parser.parse_args()
 
@@ -26,58 +43,19 @@ script_template = """#! /bin/bash
 #SBATCH --ntasks=1
 #SBATCH --cpus-per-task=4
 #SBATCH --hint=nomultithread
-#SBATCH --output="/home/xray/schneiderm/log_files/{Functional}_{system_name}_"%j.out
+#SBATCH --output="{log_dir}/{Functional}_{system_name}_"%j.out
 # Executable
 python -m script --System {system_name} --NFinal {NFinal} --Functional {Functional}"""
-dispersion_script_template = """#! /bin/bash
-#SBATCH --job-name="E {system_name} {Functional}"
-#SBATCH --ntasks=1
-#SBATCH --cpus-per-task=4
-#SBATCH --hint=nomultithread
-#SBATCH --output="/home/xray/schneiderm/log_files/D3(BJ)_{system_name}_"%j.out
-# Executable
-python -m script --Dispersion True --System {system_name} --NFinal {NFinal}"""
 
 
 def WriteSystems(NFinal=30, Suff=""):
-    Y = yaml.safe_load(open("GoodSamples/AllElements_%03d%s.yaml" % (NFinal, Suff)))
-    IDs = []
-    FC = open("GIF/ComboList_%d.txt" % (NFinal), "w")
-    for Set in Y:
-        for l in sorted(Y[Set]):
-            ID0 = Set + "-" + "%d" % (l)
-
-            Comment = ID0 + " : energy = %.4f" % (Y[Set][l]["Energy"])
-
-            FC.write("%s:\n" % (ID0))
-            FC.write("  Energy: %.4f\n" % (Y[Set][l]["Energy"]))
-            FC.write("  Weight: %.4f\n" % (Y[Set][l]["Weight"]))
-            FC.write("  Species:\n")
-            SS = Y[Set][l]["Species"]
-            for P in SS:
-                ID = ID0 + "-" + str(P)
-                IDs += [ID]
-
-                FC.write('    - { ID: "%s", Count: %d }\n' % (ID, SS[P]["Count"]))
-
-                C = SS[P]["Charge"]
-                D = SS[P]["UHF"] + 1
-
-                F = open("GIF/%s.gif_" % (ID), "w")
-                F.write("%s\n\n" % (ID))
-                F.write("%d %d\n" % (C, D))
-                for l in range(SS[P]["Number"]):
-                    x, y, z = tuple(SS[P]["Positions"][l])
-                    F.write(
-                        "%-4s %12.5f %12.5f %12.5f\n" % (SS[P]["Elements"][l], x, y, z)
-                    )
-                F.close()
-    FC.close()
-
+    # Geometries and reactions into the benchmark store, plus the system list
+    IDs = build_store(NFinal, Suff)
     F = open("GIF/FullList_%d.txt" % (NFinal), "w")
-    for ID in list(set(IDs)):
+    for ID in IDs:
         F.write("%s.gif_\n" % (ID))
     F.close()
+    return IDs
 
 
 def G16ExtractEnergies(FileName):
@@ -96,19 +74,22 @@ def G16ExtractEnergies(FileName):
         if len(T) > 1:
             ID = T[0][:-5]
             En = float(T[1])
-            E[ID] = En * 627.509  # Ha -> kcal/mol
+            E[ID] = En * HARTREE_TO_KCAL
         else:
             print("Warning! %s not defined" % (T[0]))
     return E
 
 
 def ReadSystems(NFinal=NFinal, InputFile=None):
-    Y = yaml.safe_load(open("GIF/ComboList_%d.txt" % (NFinal)))
+    Y = reactions(NFinal)
 
     if InputFile is None:
-        InputFile = f"Results/EnergyList_{NFinal}_{Functional}.txt"
-
-    G16Energy = G16ExtractEnergies(InputFile)
+        # Energies of Functional in the results database, Ha -> kcal/mol
+        G16Energy = {
+            ID: En * HARTREE_TO_KCAL for ID, En in read_energies(Functional).items()
+        }
+    else:
+        G16Energy = G16ExtractEnergies(InputFile)
 
     WarningList = []
 
@@ -161,53 +142,64 @@ def ReadSystems(NFinal=NFinal, InputFile=None):
 
 
 Mode = Opts.Mode.upper()[:2]
-if Mode == "GE":  # Generation mode - makes the .gif_ files
-    WriteSystems(NFinal=NFinal)
-    filenames = sorted(list(os.walk("GIF"))[0][2:][0])
-    filenames = [name for name in filenames if name.endswith(".gif_")]
-    for name in filenames:
-        system_name = name[:-5]
-        dir = f"GIF/{system_name}"
-        old_dir = f"GIF/{system_name}.gif_"
-        new_dir = f"{dir}/{system_name}.gif_"
-        try:
-            os.mkdir(dir)
-            os.rename(old_dir, new_dir)
-        except:
-            print(f"{dir} already exists")
+if Mode == "GE":  # Generation mode - builds the benchmark store
+    os.makedirs(Opts.LogDir, exist_ok=True)
+    for system_name in sorted(WriteSystems(NFinal=NFinal)):
+        os.makedirs(f"GIF/{system_name}", exist_ok=True)
         for Functional in func_dict:
             with open(
                 f"GIF/{system_name}/calculate_system_energy_{Functional}.slurm", "w"
             ) as file:
                 file.write(
                     script_template.format(
-                        system_name=system_name, NFinal=NFinal, Functional=Functional
+                        system_name=system_name,
+                        NFinal=NFinal,
+                        Functional=Functional,
+                        log_dir=Opts.LogDir,
                     )
                 )
             print(f"GIF/{system_name}/calculate_system_energy_{Functional}.slurm")
-        for non_nn in ["PBE", "XAlpha", "r2SCAN"]:
+        for non_nn in non_nn_functionals:
             with open(
                 f"GIF/{system_name}/calculate_system_energy_{non_nn}.slurm", "w"
             ) as file:
                 file.write(
                     script_template.format(
-                        system_name=system_name, NFinal=NFinal, Functional=non_nn
+                        system_name=system_name,
+                        NFinal=NFinal,
+                        Functional=non_nn,
+                        log_dir=Opts.LogDir,
                     )
                 )
+elif Mode == "CE" and Opts.Executor == "local":
+    # Imported here: the analysis mode needs neither PySCF nor torch
+    from batch import run_batch, xc_backend
+    from density_functional_approximation_dm21.threads import (
+        allotted_cpus,
+        configure_threads,
+    )
+    from script import read_system_list
+
+    functionals = non_nn_functionals if Functional == "Non-NN" else [Functional]
+    workers = Opts.Workers or allotted_cpus()[0]
+    if workers == 1:
+        configure_threads(backend=xc_backend(functionals))
+    run_batch(
+        read_system_list(f"GIF/FullList_{NFinal}.txt"), functionals, workers=workers
+    )
 elif Mode == "CE":
     filenames = list(os.walk("GIF"))[1:]
     for name in sorted(filenames):
         current_path = name[0].replace("\\", "/")
-        slurm_path = f"/home/xray/schneiderm/SCF-calculations/{current_path}/calculate_system_energy_{Functional}.slurm"
+        slurm_path = os.path.abspath(
+            f"{current_path}/calculate_system_energy_{Functional}.slurm"
+        )
         print(slurm_path)
         os.system(f"sbatch {slurm_path}")
 
 elif Mode == "D3":
-    filenames = list(os.walk("GIF"))[1:]
-    for name in sorted(filenames):
-        current_path = name[0].replace("\\", "/")
-        slurm_path = f"{current_path}/calculate_system_dispersion.slurm"
-        os.system(f"sbatch {slurm_path}")
+    # All species in one process, into the dispersion store
+    os.system(f"python -m script --Dispersion True --NFinal {NFinal}")
 else:
     MAE, Errors = ReadSystems(NFinal)
     print(
@@ -1,36 +1,28 @@
-from optparse import OptionParser
+from density_functional_approximation_dm21.dispersion_store import (
+    compute_dispersions,
+    parametrization_name,
+)
+from results_db import read_energies, write_results
+from script import system_molecule
 
-parser = OptionParser()
-parser.add_option("--NFinal", type=int, default=50, help="Number systems to select")
-
-(Opts, args) = parser.parse_args()
-
-NFinal = Opts.NFinal
+# D3(BJ) parametrization added to the energies of each functional
+dispersion_xc = {"PBE": "PBE", "XAlpha": "PBE0"}
 
+for functional in ["PBE", "XAlpha"]:
+    energy_dict = read_energies(functional)
 
-paths = {
-    "PBE": ("Results/EnergyList_{NFinal}_PBE.txt", "Results/DispersionList_PBE.txt"),
-    "XAlpha": (
-        "Results/EnergyList_{NFinal}_XAlpha.txt",
-        "Results/DispersionList_PBE0.txt",
-    ),
-}
+    # Read from the dispersion store, computed there for systems it lacks
+    parametrization = (dispersion_xc[functional], "d3bj")
+    molecules = [system_molecule(system_name) for system_name in energy_dict]
+    dispersions = compute_dispersions(molecules, [parametrization])
+    name = parametrization_name(*parametrization)
 
-for functional in ["PBE", "XAlpha"]:
-    energy_dict = dict()
-    energy_path, dispersion_path = paths[functional]
-    for path in energy_path, dispersion_path:
-        with open(path, "r") as file:
-            for line in file:
-                system_name, energy = line.strip().split()
-                system_name = system_name.split(".gif_")[0]
-                energy = float(energy)
-                if energy_dict.get(system_name) is None:
-                    energy_dict[system_name] = [
-                        energy,
-                    ]
-                else:
-                    energy_dict[system_name].append(energy)
-    with open(f"Results/EnergyList_{NFinal}_{functional}_D3BJ.txt", "w") as file:
-        for system in energy_dict:
-            file.write(f"{system}.gif_ {sum(energy_dict[system])}\n")
+    write_results(
+        {
+            "system": system,
+            "functional": f"{functional}_D3BJ",
+            "energy": energy_dict[system] + dispersion[name],
+            "d3": dispersion[name],
+        }
+        for system, dispersion in zip(energy_dict, dispersions)
+    )
@@ -0,0 +1,239 @@
+import time
+from multiprocessing import Pool
+from optparse import OptionParser
+
+from pyscf import dft, gto
+from pyscf.dft import gen_grid
+
+from density_functional_approximation_dm21.model_paths import omega_family
+from density_functional_approximation_dm21.threads import (
+    allotted_cpus,
+    configure_threads,
+)
+from script import (
+    calculate_functional_energy,
+    calculate_non_nn_functional_energy,
+    get_coords_charge_spin,
+    initialize_molecule,
+    initialize_scf,
+    read_system_list,
+    result_fields,
+    result_label,
+    system_molecule,
+    write_energy,
+)
+from results_db import read_energies
+
+
+def finished_systems(functional, density_fit=False):
+    """Systems with a successful result of functional in the results database"""
+    return set(read_energies(result_label(functional, density_fit)))
+
+
+def estimated_cost(system_name):
+    """
+    Relative cost of an SCF of system_name: basis functions times grid points
+    (radial times angular points of each atom, before pruning)
+    """
+    molecule = system_molecule(system_name, verbose=0)
+    level = dft.Grids(molecule).level
+    ngrids = 0
+    for i in range(molecule.natm):
+        # Grids follow the nuclear charge, also for ECP atoms
+        charge = gto.charge(molecule.atom_pure_symbol(i))
+        nrad = gen_grid._default_rad(charge, level)
+        nang = gen_grid._default_ang(charge, level)
+        ngrids += nrad * nang
+    return molecule.nao * ngrids
+
+
+def system_energies(system_name, functionals, density_fit=False, **options):
+    """
+    Energies of one system, each written to the results database as soon as
+    it is known. The molecule and the grid are built once, and each
+    converged density is the initial guess of the next functional.
+    """
+    print("\n\n", system_name, "\n\n")
+    try:
+        coords, charge, spin = get_coords_charge_spin(system_name)
+        molecule, mf = initialize_molecule(coords, charge, spin, density_fit)
+    except Exception as E:
+        print(E)
+        for functional in functionals:
+            write_energy(system_name, functional, "ERROR", density_fit, error=str(E))
+        return
+    mf.chkfile = None
+    grids, dm0 = None, None
+
+    for functional in functionals:
+        print(f"\n\n{functional} calculation \n\n")
+        if grids is not None:
+            mf = initialize_scf(molecule, density_fit)
+            mf.chkfile = None
+            mf.grids = grids
+        start, error = time.perf_counter(), None
+        try:
+            if "NN" in functional:
+                energy = calculate_functional_energy(
+                    mf, functional, dm0=dm0, system_name=system_name, **options
+                )
+            else:
+                energy = calculate_non_nn_functional_energy(mf, functional, dm0=dm0)
+            if mf.converged:
+                dm0 = mf.make_rdm1()
+        except Exception as E:
+            print(E)
+            energy, error = "ERROR", str(E)
+        grids = mf.grids
+        fields = result_fields(
+            mf, functional, energy, time.perf_counter() - start, error
+        )
+        write_energy(system_name, functional, energy, density_fit, **fields)
+
+
+def xc_backend(functionals, backend="torch"):
+    """Backend of the NN functionals among functionals, None without any"""
+    return backend if any("NN" in functional for functional in functionals) else None
+
+
+def run_system(task):
+    system_name, functionals, options = task
+    system_energies(system_name, functionals, **options)
+    return system_name
+
+
+def run_batch(system_names, functionals, workers=1, density_fit=False, **options):
+    """
+    Energies of every system with every functional in this process (workers=1)
+    or in a pool of workers that split the allotted CPUs; options["xc_threads"]
+    overrides the torch threads of the NN XC evaluation. Pairs that already
+    have a successful result are skipped, so an interrupted run resumes where
+    it stopped. Pool workers take the systems by decreasing estimated cost,
+    which keeps the largest ones from starting last.
+    """
+    finished = {
+        functional: finished_systems(functional, density_fit)
+        for functional in functionals
+    }
+    options = dict(options, density_fit=density_fit)
+    tasks = []
+    for system_name in system_names:
+        pending = [
+            functional
+            for functional in functionals
+            if system_name not in finished[functional]
+        ]
+        if pending:
+            tasks.append((system_name, pending, options))
+    print(f"{len(tasks)} of {len(system_names)} systems to calculate")
+
+    if workers == 1:
+        for task in tasks:
+            run_system(task)
+        return
+
+    costs = {}
+    for system_name, pending, _ in tasks:
+        try:
+            costs[system_name] = estimated_cost(system_name) * len(pending)
+        except Exception as E:
+            print(E)
+            costs[system_name] = 0
+    tasks.sort(key=lambda task: costs[task[0]], reverse=True)
+
+    threads = max(allotted_cpus()[0] // workers, 1)
+    xc_threads = options.get("xc_threads") or threads
+    backend = xc_backend(functionals, options.get("backend", "torch"))
+    with Pool(
+        workers,
+        initializer=configure_threads,
+        initargs=(threads, xc_threads, backend),
+    ) as pool:
+        for done, system_name in enumerate(pool.imap_unordered(run_system, tasks)):
+            print(f"{system_name} done ({done + 1} of {len(tasks)})")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option(
+        "--Systems",
+        type=str,
+        default=None,
+        help="List of systems (default: GIF/FullList_{NFinal}.txt)",
+    )
+    parser.add_option(
+        "--Functionals",
+        type=str,
+        default="",
+        help="Comma separated functionals (NN checkpoints or PySCF xc names)",
+    )
+    parser.add_option(
+        "--Family",
+        type=str,
+        default=None,
+        help="NN_PBE or NN_XALPHA: add the omega checkpoints found on disk",
+    )
+    parser.add_option(
+        "--Workers",
+        type=int,
+        default=1,
+        help="Worker processes, each with an equal share of the allotted CPUs",
+    )
+    parser.add_option(
+        "--Newton",
+        action="store_true",
+        default=False,
+        help="Second-order SCF for NN functionals",
+    )
+    parser.add_option(
+        "--DensityFit",
+        action="store_true",
+        default=False,
+        help="Density fitting (RI-J; JK fitting for hybrids)",
+    )
+    parser.add_option(
+        "--XCThreads",
+        type=int,
+        default=None,
+        help="torch threads of each worker for the NN XC evaluation "
+        "(default: its share of the allotted CPUs; not with --Backend numpy)",
+    )
+    parser.add_option("--Backend", type=str, default="torch", help="torch or numpy")
+    parser.add_option(
+        "--Precision", type=str, default="float64", help="float64, float32 or mixed"
+    )
+    parser.add_option(
+        "--NFinal", type=int, default=30, help="Number of systems to select"
+    )
+
+    (Opts, args) = parser.parse_args()
+
+    if Opts.Backend == "numpy" and Opts.XCThreads:
+        parser.error(
+            "--XCThreads sets torch threads, the numpy backend runs on "
+            "each worker's share of the allotted CPUs"
+        )
+    functionals = [name for name in Opts.Functionals.split(",") if name]
+    if Opts.Family:
+        functionals += omega_family(Opts.Family, on_disk=True)
+    # A checkpoint given in --Functionals and --Family is evaluated once
+    functionals = list(dict.fromkeys(functionals))
+    system_list = Opts.Systems or f"GIF/FullList_{Opts.NFinal}.txt"
+    system_names = read_system_list(system_list)
+
+    if Opts.Workers == 1:
+        configure_threads(
+            xc_threads=Opts.XCThreads, backend=xc_backend(functionals, Opts.Backend)
+        )
+
+    run_batch(
+        system_names,
+        functionals,
+        workers=Opts.Workers,
+        density_fit=Opts.DensityFit,
+        newton=Opts.Newton,
+        backend=Opts.Backend,
+        precision=Opts.Precision,
+        xc_threads=Opts.XCThreads,
+    )
@@ -0,0 +1,176 @@
+import functools
+import os
+
+import h5py
+import numpy as np
+import yaml
+
+# Species geometries and reaction stoichiometries of the Diet GMTKN55 sets in
+# one HDF5 file, built by InterfaceG16 --Mode GE. Species of all sets share
+# /species (flat arrays, atoms of species i at offsets[i]:offsets[i + 1]);
+# the reactions of each set are in /reactions/{NFinal}.
+benchmark_store_path = os.environ.get(
+    "NN_FUNCTIONAL_BENCHMARK_STORE", "GIF/benchmark.h5"
+)
+
+string_dtype = h5py.string_dtype()
+
+
+def read_benchmark_yaml(NFinal=30, Suff=""):
+    """
+    Species ({ID: (elements, positions in Angstrom, charge, multiplicity)})
+    and reactions ({ID: {"Energy", "Weight", "Species": [{"ID", "Count"}]}})
+    of GoodSamples/AllElements_{NFinal}{Suff}.yaml
+    """
+    with open("GoodSamples/AllElements_%03d%s.yaml" % (NFinal, Suff), "r") as file:
+        Y = yaml.safe_load(file)
+
+    species, reactions = {}, {}
+    for Set in Y:
+        for l in sorted(Y[Set]):
+            ID0 = Set + "-" + "%d" % (l)
+            SS = Y[Set][l]["Species"]
+            reactions[ID0] = {
+                "Energy": Y[Set][l]["Energy"],
+                "Weight": Y[Set][l]["Weight"],
+                "Species": [
+                    {"ID": ID0 + "-" + str(P), "Count": SS[P]["Count"]} for P in SS
+                ],
+            }
+            for P in SS:
+                species[ID0 + "-" + str(P)] = (
+                    list(SS[P]["Elements"]),
+                    np.array(SS[P]["Positions"], dtype=float).reshape(-1, 3),
+                    SS[P]["Charge"],
+                    SS[P]["UHF"] + 1,
+                )
+    return species, reactions
+
+
+def read_species(file):
+    """{ID: (elements, positions, charge, multiplicity)} of an open store"""
+    group = file["species"]
+    ids = group["id"].asstr()[()]
+    offsets = group["offsets"][()]
+    elements = group["elements"].asstr()[()]
+    positions = group["positions"][()]
+    charges = group["charge"][()]
+    multiplicities = group["multiplicity"][()]
+    return {
+        ID: (
+            list(elements[start:end]),
+            positions[start:end],
+            int(charge),
+            int(multiplicity),
+        )
+        for ID, start, end, charge, multiplicity in zip(
+            ids, offsets[:-1], offsets[1:], charges, multiplicities
+        )
+    }
+
+
+def write_species(group, species):
+    elements, positions, charges, multiplicities = zip(*species.values())
+    group.create_dataset("id", data=list(species), dtype=string_dtype)
+    group.create_dataset("offsets", data=np.cumsum([0] + list(map(len, elements))))
+    group.create_dataset("elements", data=sum(elements, []), dtype=string_dtype)
+    group.create_dataset("positions", data=np.concatenate(positions))
+    group.create_dataset("charge", data=charges)
+    group.create_dataset("multiplicity", data=multiplicities)
+
+
+def write_reactions(group, reactions):
+    stoichiometries = [reaction["Species"] for reaction in reactions.values()]
+    species = [s for S in stoichiometries for s in S]
+    group.create_dataset("id", data=list(reactions), dtype=string_dtype)
+    group.create_dataset("energy", data=[R["Energy"] for R in reactions.values()])
+    group.create_dataset("weight", data=[R["Weight"] for R in reactions.values()])
+    group.create_dataset(
+        "offsets", data=np.cumsum([0] + list(map(len, stoichiometries)))
+    )
+    group.create_dataset("species", data=[s["ID"] for s in species], dtype=string_dtype)
+    group.create_dataset("count", data=[s["Count"] for s in species])
+
+
+def build_store(NFinal=30, Suff="", path=None):
+    """
+    Adds the species and reactions of GoodSamples/AllElements_{NFinal}{Suff}.yaml
+    to the store, keeping those of the other sets. The file is rewritten next
+    to the old one and swapped in, so running jobs never read it half-written.
+    Returns the species IDs of the set.
+    """
+    path = path or benchmark_store_path
+    new_species, reactions = read_benchmark_yaml(NFinal, Suff)
+
+    species = {}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    old = h5py.File(path, "r") if os.path.exists(path) else None
+    try:
+        if old is not None:
+            species = read_species(old)
+        species.update(new_species)
+        with h5py.File(path + ".tmp", "w") as file:
+            write_species(file.create_group("species"), species)
+            sets = file.create_group("reactions")
+            if old is not None:
+                for name in old["reactions"]:
+                    if name != str(NFinal):
+                        old.copy(old["reactions"][name], sets)
+            write_reactions(sets.create_group(str(NFinal)), reactions)
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(path + ".tmp", path)
+    load_species.cache_clear()
+    return list(new_species)
+
+
+def open_store(path=None):
+    path = path or benchmark_store_path
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No benchmark store {path}: python -m InterfaceG16 --Mode GE builds it"
+        )
+    return h5py.File(path, "r")
+
+
+@functools.lru_cache(maxsize=None)
+def load_species(path=None):
+    """All species of the store, read once per process"""
+    with open_store(path) as file:
+        return read_species(file)
+
+
+def species_geometry(ID, path=None):
+    """(elements, positions in Angstrom, charge, multiplicity) of species ID"""
+    species = load_species(path)
+    if ID not in species:
+        raise KeyError(f"{ID} not in the benchmark store")
+    return species[ID]
+
+
+def reactions(NFinal=30, path=None):
+    """{ID: {"Energy", "Weight", "Species": [{"ID", "Count"}]}} of a set"""
+    with open_store(path) as file:
+        if str(NFinal) not in file["reactions"]:
+            raise KeyError(f"No reactions of the {NFinal} set in the benchmark store")
+        group = file["reactions"][str(NFinal)]
+        ids = group["id"].asstr()[()]
+        energies = group["energy"][()]
+        weights = group["weight"][()]
+        offsets = group["offsets"][()]
+        species = group["species"].asstr()[()]
+        counts = group["count"][()]
+    return {
+        ID: {
+            "Energy": float(energy),
+            "Weight": float(weight),
+            "Species": [
+                {"ID": s, "Count": int(count)}
+                for s, count in zip(species[start:end], counts[start:end])
+            ],
+        }
+        for ID, energy, weight, start, end in zip(
+            ids, energies, weights, offsets[:-1], offsets[1:]
+        )
+    }
@@ -0,0 +1,199 @@
+import os
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from batch import xc_backend
+from benchmark_store import reactions
+from density_functional_approximation_dm21.constants import HARTREE_TO_KCAL
+from density_functional_approximation_dm21.threads import configure_threads
+from script import (
+    calculate_functional_energy,
+    calculate_non_nn_functional_energy,
+    get_coords_charge_spin,
+    initialize_molecule,
+    initialize_scf,
+    read_system_list,
+)
+
+
+def fitting_deviations(system_name, functionals, **options):
+    """
+    [(functional, exact energy, density-fitted energy, exact seconds, fitted
+    seconds)] of one system. The SCF runs with density fitting, the exact
+    energy is the one of its converged density with exact J (and K). The SCF
+    energy is variational, so this differs from the exact-J SCF energy only
+    to second order in the density change. The seconds are those of one
+    energy evaluation (Fock build) at that density.
+    """
+    print("\n\n", system_name, "\n\n")
+    coords, charge, spin = get_coords_charge_spin(system_name)
+
+    deviations = []
+    for functional in functionals:
+        print(f"\n\n{functional} calculation, density fitting\n\n")
+        _, mf = initialize_molecule(coords, charge, spin, density_fit=True)
+        mf.chkfile = None
+        if "NN" in functional:
+            energy = calculate_functional_energy(
+                mf, functional, system_name=system_name, **options
+            )
+        else:
+            energy = calculate_non_nn_functional_energy(mf, functional)
+
+        # Exact J on the same functional and grid
+        exact_mf = initialize_scf(mf.mol)
+        exact_mf.xc, exact_mf._numint, exact_mf.grids = mf.xc, mf._numint, mf.grids
+
+        dm = mf.make_rdm1()
+        energies, timings = [], []
+        for scf in (exact_mf, mf):
+            start = time.perf_counter()
+            energies.append(scf.energy_tot(dm))
+            timings.append(time.perf_counter() - start)
+        exact = energy + energies[0] - energies[1]
+        deviations.append((functional, exact, energy, *timings))
+    return deviations
+
+
+def read_report(path):
+    """
+    {system: [(functional, exact energy, density-fitted energy, exact
+    seconds, fitted seconds)]} of the systems already in the report path
+    """
+    deviations = {}
+    if not os.path.exists(path):
+        return deviations
+    with open(path) as file:
+        for line in file:
+            system, functional, exact, fitted, _, exact_time, fitted_time = line.split()
+            deviations.setdefault(system.removesuffix(".gif_"), []).append(
+                (
+                    functional,
+                    float(exact),
+                    float(fitted),
+                    float(exact_time),
+                    float(fitted_time),
+                )
+            )
+    return deviations
+
+
+def write_rows(path, system_name, rows):
+    """Appends the deviations (kcal/mol) of one system to the report path"""
+    with open(path, "a") as file:
+        for functional, exact, fitted, exact_time, fitted_time in rows:
+            deviation = (fitted - exact) * HARTREE_TO_KCAL
+            file.write(
+                f"{system_name}.gif_ {functional} {exact} {fitted} "
+                f"{deviation:.6f} {exact_time:.1f} {fitted_time:.1f}\n"
+            )
+
+
+def reaction_deviations(deviations, functional, NFinal=30):
+    """
+    {reaction: fitted - exact reaction energy (kcal/mol)} of functional for
+    the reactions of the set whose species are all in deviations
+    """
+    species = {
+        system: fitted - exact
+        for system, rows in deviations.items()
+        for name, exact, fitted, *_ in rows
+        if name == functional
+    }
+    return {
+        ID: HARTREE_TO_KCAL
+        * sum(species[S["ID"]] * S["Count"] for S in reaction["Species"])
+        for ID, reaction in reactions(NFinal).items()
+        if all(S["ID"] in species for S in reaction["Species"])
+    }
+
+
+def summarize(deviations, functionals, NFinal=30):
+    """
+    Mean absolute and maximum deviation of the species and reaction energies
+    and the Fock build speed-up of every functional
+    """
+    for functional in functionals:
+        rows = np.array(
+            [
+                row[1:]
+                for rows in deviations.values()
+                for row in rows
+                if row[0] == functional
+            ]
+        )
+        if len(rows) == 0:
+            print(f"{functional}: no systems")
+            continue
+        deviation = np.abs(rows[:, 1] - rows[:, 0]) * HARTREE_TO_KCAL
+        print(
+            f"{functional}: {len(rows)} systems, MAD {deviation.mean():.4f} kcal/mol, "
+            f"max {deviation.max():.4f} kcal/mol, "
+            f"Fock build {rows[:, 2].sum() / rows[:, 3].sum():.2f}x faster"
+        )
+        reaction = np.abs(
+            list(reaction_deviations(deviations, functional, NFinal).values())
+        )
+        if len(reaction) > 0:
+            print(
+                f"{functional}: {len(reaction)} reactions, "
+                f"MAD {reaction.mean():.4f} kcal/mol, max {reaction.max():.4f} kcal/mol"
+            )
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option(
+        "--Systems",
+        type=str,
+        default=None,
+        help="List of systems (default: GIF/FullList_{NFinal}.txt)",
+    )
+    parser.add_option(
+        "--Functionals",
+        type=str,
+        default="NN_PBE_star,PBE",
+        help="Comma separated functionals (NN checkpoints or PySCF xc names)",
+    )
+    parser.add_option(
+        "--Threads",
+        type=int,
+        default=None,
+        help="Threads for PySCF and torch (default: CPUs allotted to the job)",
+    )
+    parser.add_option(
+        "--NFinal", type=int, default=30, help="Number of systems to select"
+    )
+
+    (Opts, args) = parser.parse_args()
+
+    functionals = [name for name in Opts.Functionals.split(",") if name]
+    system_list = Opts.Systems or f"GIF/FullList_{Opts.NFinal}.txt"
+
+    configure_threads(Opts.Threads, Opts.Threads, xc_backend(functionals))
+
+    # Systems already in the report are skipped, so an interrupted run
+    # resumes where it stopped
+    path = f"Results/DensityFitting_{Opts.NFinal}.txt"
+    deviations = read_report(path)
+    system_names = read_system_list(system_list)
+    for system_name in system_names:
+        done = {row[0] for row in deviations.get(system_name, [])}
+        pending = [name for name in functionals if name not in done]
+        if not pending:
+            continue
+        try:
+            rows = fitting_deviations(system_name, pending)
+        except Exception as E:
+            print(E)
+            continue
+        write_rows(path, system_name, rows)
+        deviations.setdefault(system_name, []).extend(rows)
+    summarize(
+        {name: deviations[name] for name in system_names if name in deviations},
+        functionals,
+        Opts.NFinal,
+    )
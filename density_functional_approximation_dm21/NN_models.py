@@ -1,42 +1,13 @@
 import torch
 from torch import nn
-import numpy as np
+
+from .constants import PBE_CONSTANTS
 
 device = torch.device("cpu")
 
-true_constants_PBE = torch.Tensor(
-    [
-        [
-            0.06672455,
-            (1 - torch.log(torch.Tensor([2]))) / (np.pi**2),
-            1.709921,
-            7.5957,
-            14.1189,
-            10.357,
-            3.5876,
-            6.1977,
-            3.6231,
-            1.6382,
-            3.3662,
-            0.88026,
-            0.49294,
-            0.62517,
-            0.49671,
-            # 1,  1,  1,
-            0.031091,
-            0.015545,
-            0.016887,
-            0.21370,
-            0.20548,
-            0.11125,
-            -3 / 8 * (3 / np.pi) ** (1 / 3) * 4 ** (2 / 3),
-            0.8040,
-            0.2195149727645171,
-            0.8040,
-            0.2195149727645171,
-        ]
-    ]
-).to(device)
+true_constants_PBE = torch.Tensor([PBE_CONSTANTS]).to(device)
+# Scales of the PBE parameters (beta, gamma, kappa_up, mu_up, kappa_down, mu_down) the models return
+pbe_parameter_scale = true_constants_PBE[:, [0, 1, 22, 23, 24, 25]]
 
 sigmoid = torch.nn.Sigmoid()
 elu = torch.nn.ELU()
@@ -144,10 +115,19 @@ class MLOptimizer(nn.Module):
             spin-symmetrized enhancement factor for LDA exhange energy
         '''
         
-        result = (self.unsymm_forward(x)+self.unsymm_forward(x[:, [1, 0, 4, 3, 2, 6, 5]]))/2
+        n = x.shape[0]
+        # Both spin orderings in one pass
+        result = self.unsymm_forward(torch.cat([x, x[:, [1, 0, 4, 3, 2, 6, 5]]]))
+        result = (result[:n]+result[n:])/2
 
         return result
 
+    def forward_unpolarized(self, x):
+        '''
+        forward for closed-shell inputs, which the spin permutation leaves unchanged
+        '''
+        return self.unsymm_forward(x)
+
 
 class pcPBEMLOptimizer(nn.Module):
     def __init__(self, num_layers, h_dim, nconstants_x=2, nconstants_c=2, dropout=0.2, DFT=None):
@@ -205,48 +185,25 @@ class pcPBEMLOptimizer(nn.Module):
         return (sigmoid(8*x)+1.5)/2
 
 
-    def get_exchange_constants(self, x):
-
-        x_x_up = self.hidden_layers_x(x[:, [2, 5]])
-        x_x_down = self.hidden_layers_x(x[:, [4, 6]])
-
-        return x_x_up[:, 1], x_x_up[:, 0], x_x_down[:, 1], x_x_down[:, 0]
-
-    def get_correlation_constants(self, x):
-
-        x_c = self.hidden_layers_c(x)
-
-        return x_c[:, 0], x_c[:, 1]
-
-
     @staticmethod
-    def all_sigma_zero(x):
+    def correlation_inputs(x):
         '''
-        Function for parameter mu constraint
+        x, x with zero gradients (beta constraint) and x with infinite densities
+        (gamma constraint) stacked for one pass of hidden_layers_c
         '''
-        return torch.hstack([x[:, :2], torch.zeros_like(x[:, 2:]).to(x.device)])  #0.76159415595*torch.ones_like(x[:, 5:])])
+        n = x.shape[0]
+        inputs = x.repeat(3, 1)
+        inputs[n:2*n, 2:5] = 0
+        inputs[2*n:, :2] = 1
+        return inputs
 
     @staticmethod
-    def all_sigma_inf(x):
-        '''
-        Function for PW91 correlation parameters constraint
-        '''
-        return torch.hstack([x[:, :2], torch.ones([x.shape[0], 5]).to(x.device)])
-    
-    @staticmethod
-    def all_sigma_zero_beta(x):
+    def exchange_inputs(x):
         '''
-        Function for parameter beta constraint
+        Spin up, spin down and the zero gradient input of the mu constraint (the same
+        zero row for both spins) stacked for one pass of hidden_layers_x
         '''
-        return torch.hstack([x[:, :2], torch.zeros([x.shape[0], 3]).to(x.device), x[:, 5:]])
-
-    
-    @staticmethod
-    def all_rho_inf(x):
-        '''
-        Function for parameter gamma constraint
-        '''
-        return torch.hstack([torch.ones([x.shape[0], 2]).to(x.device), x[:, 2:]])
+        return torch.cat([x[:, [2, 5]], x[:, [4, 6]], x.new_zeros(1, 2)])
 
     @staticmethod
     def shifted_elu(x):
@@ -254,28 +211,48 @@ class pcPBEMLOptimizer(nn.Module):
 
     def forward(self, x):
 
-        mu_up, kappa_up, mu_down, kappa_down = self.get_exchange_constants(x)
+        n = x.shape[0]
+        x_x = self.hidden_layers_x(self.exchange_inputs(x))
+        x_c = self.hidden_layers_c(self.correlation_inputs(x))
 
-        beta, gamma = self.get_correlation_constants(x)
+        mu_up, kappa_up = x_x[:n, 1], x_x[:n, 0]
+        mu_down, kappa_down = x_x[n:2*n, 1], x_x[n:2*n, 0]
+        mu_sigma_zero = x_x[2*n:, 1]
 
-        beta = self.beta_activation((beta - self.get_correlation_constants(self.all_sigma_zero_beta(x))[0]).view(-1,1))
-        gamma = self.shifted_elu((gamma - self.get_correlation_constants(self.all_rho_inf(x))[1]).view(-1,1))
-        mu_up = self.shifted_elu((mu_up - self.get_exchange_constants(self.all_sigma_zero(x))[0])).view(-1,1)
-        mu_down = self.shifted_elu((mu_down - self.get_exchange_constants(self.all_sigma_zero(x))[2])).view(-1,1)
+        beta = self.beta_activation((x_c[:n, 0] - x_c[n:2*n, 0]).view(-1,1))
+        gamma = self.shifted_elu((x_c[:n, 1] - x_c[2*n:, 1]).view(-1,1))
+        mu_up = self.shifted_elu((mu_up - mu_sigma_zero)).view(-1,1)
+        mu_down = self.shifted_elu((mu_down - mu_sigma_zero)).view(-1,1)
         kappa_up = self.kappa_activation(kappa_up).view(-1,1)
         kappa_down = self.kappa_activation(kappa_down).view(-1,1)
 
-        return torch.hstack([beta, gamma, torch.ones([x.shape[0], 20]).to(x.device), kappa_up, mu_up, kappa_down, mu_down])*true_constants_PBE.to(x.device)
+        return torch.hstack([beta, gamma, kappa_up, mu_up, kappa_down, mu_down])*pbe_parameter_scale.to(x.device)
+
+    def forward_unpolarized(self, x):
+        '''
+        forward for closed-shell inputs (x[:, [2, 5]] == x[:, [4, 6]]):
+        one exchange pass serves both spins
+        '''
+        n = x.shape[0]
+        x_x = self.hidden_layers_x(torch.cat([x[:, [2, 5]], x.new_zeros(1, 2)]))
+        x_c = self.hidden_layers_c(self.correlation_inputs(x))
+
+        beta = self.beta_activation((x_c[:n, 0] - x_c[n:2*n, 0]).view(-1,1))
+        gamma = self.shifted_elu((x_c[:n, 1] - x_c[2*n:, 1]).view(-1,1))
+        mu = self.shifted_elu((x_x[:n, 1] - x_x[n:, 1])).view(-1,1)
+        kappa = self.kappa_activation(x_x[:n, 0]).view(-1,1)
+
+        return torch.hstack([beta, gamma, kappa, mu])*pbe_parameter_scale[:, :4].to(x.device)
 
 
 class pcPBEstar(pcPBEMLOptimizer):
 
     def get_exchange_constants(self, x):
 
-        x_x_up = self.hidden_layers_x(x[:, [2, 5]])
-        x_x_down = self.hidden_layers_x(x[:, [4, 6]])
+        n = x.shape[0]
+        x_x = self.hidden_layers_x(torch.cat([x[:, [2, 5]], x[:, [4, 6]]]))
 
-        return x_x_up[:, 1].view(-1,1), x_x_up[:, 0].view(-1,1), x_x_down[:, 1].view(-1,1), x_x_down[:, 0].view(-1,1)
+        return x_x[:n, 1].view(-1,1), x_x[:n, 0].view(-1,1), x_x[n:, 1].view(-1,1), x_x[n:, 0].view(-1,1)
 
     def get_correlation_constants(self, x):
 
@@ -296,7 +273,19 @@ class pcPBEstar(pcPBEMLOptimizer):
         beta = self.beta_activation(beta)
         gamma = self.shifted_elu(gamma)
 
-        return torch.hstack([beta, gamma, torch.ones([x.shape[0], 20]).to(x.device), kappa_up, mu_up, kappa_down, mu_down])*true_constants_PBE.to(x.device)
+        return torch.hstack([beta, gamma, kappa_up, mu_up, kappa_down, mu_down])*pbe_parameter_scale.to(x.device)
+
+    def forward_unpolarized(self, x):
+
+        x_x = self.hidden_layers_x(x[:, [2, 5]])
+        x_c = self.hidden_layers_c(x)
+
+        beta = self.beta_activation(x_c[:, 0].view(-1,1))
+        gamma = self.shifted_elu(x_c[:, 1].view(-1,1))
+        mu = self.shifted_elu(x_x[:, 1].view(-1,1))
+        kappa = self.kappa_activation(x_x[:, 0].view(-1,1))
+
+        return torch.hstack([beta, gamma, kappa, mu])*pbe_parameter_scale[:, :4].to(x.device)
 
 
 def NN_XALPHA_model(num_layers=6, h_dim=32, nconstants=1, dropout=0.0, DFT='XALPHA'):
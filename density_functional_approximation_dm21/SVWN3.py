@@ -1,4 +1,9 @@
+from functools import partial
+
 import torch
+
+from . import xc_formulas
+from .PBE import analytic_xc
 #from utils import catch_nan
 
 
@@ -144,11 +149,16 @@ def f_svwn3(rho, c_arr):
     return f_lda_x(rs, z, c_arr) + f_vwn(rs, z, c_arr)
 
 
-def F_XALPHA(rho, constant):
-    eps = 1e-29
-    res_energy = constant[:, 0] * LDA_X_FACTOR * (rho[:, 0] + rho[:, 1] + eps)**(1/3)
+xalpha_xc = partial(xc_formulas.xalpha_xc, torch)
+xalpha_xc_and_derivatives = partial(xc_formulas.xalpha_xc_and_derivatives, torch)
+
 
-    return res_energy
+def F_XALPHA_unpolarized(rho, constant):
+    return analytic_xc(xalpha_xc, xalpha_xc_and_derivatives, rho, constant[:, 0])
+
+
+def F_XALPHA(rho, constant):
+    return F_XALPHA_unpolarized(rho[:, 0] + rho[:, 1], constant)
 
 
 if __name__ == '__main__':
@@ -1 +1,23 @@
-from density_functional_approximation_dm21.functional import NN_FUNCTIONAL
+from density_functional_approximation_dm21.model_paths import (
+    available_models,
+    omega_family,
+)
+
+
+def __getattr__(name):
+    # Import lazily so that the NumPy backend can be used without torch
+    if name == "NN_FUNCTIONAL":
+        from density_functional_approximation_dm21.functional import NN_FUNCTIONAL
+
+        return NN_FUNCTIONAL
+    if name == "NN_FUNCTIONAL_NUMPY":
+        from density_functional_approximation_dm21.numpy_backend import (
+            NN_FUNCTIONAL_NUMPY,
+        )
+
+        return NN_FUNCTIONAL_NUMPY
+    if name == "NN_ENSEMBLE":
+        from density_functional_approximation_dm21.ensemble import NN_ENSEMBLE
+
+        return NN_ENSEMBLE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,120 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from .model_paths import cache_dir
+
+package_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def reference_features(npoints=512, seed=0, unpolarized=False):
+    """
+    Deterministic (7, npoints) features spanning the densities, reduced
+    gradients and iso-orbital indicators met in molecular grids, or the
+    (3, npoints) closed-shell (rho, sigma, tau) when unpolarized
+    """
+    generator = np.random.default_rng(seed)
+    rho = 10 ** generator.uniform(-6, 2, (2, npoints))
+    s = generator.uniform(0, 3, (2, npoints))
+    alpha = generator.uniform(0, 3, (2, npoints))
+
+    grad_norm = 2 * (3 * np.pi**2) ** (1 / 3) * rho ** (4 / 3) * s
+    direction = generator.normal(size=(2, 3, npoints))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    grad = grad_norm[:, None] * direction
+
+    sigma = np.sum(grad**2, axis=1)
+    tau_w = sigma / (8 * rho)
+    tau_tf = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * rho ** (5 / 3)
+    tau = tau_w + alpha * tau_tf
+
+    if unpolarized:
+        # Closed shell with the alpha channel in both spins
+        return torch.tensor(
+            np.stack([2 * rho[0], 4 * sigma[0], 2 * tau[0]]), dtype=torch.float64
+        )
+    return torch.tensor(
+        np.stack(
+            [
+                rho[0],
+                rho[1],
+                sigma[0],
+                sigma[1],
+                np.sum((grad[0] + grad[1]) ** 2, axis=0),
+                tau[0],
+                tau[1],
+            ]
+        ),
+        dtype=torch.float64,
+    )
+
+
+def energy_and_gradient(energy_density, features):
+    features = features.clone().requires_grad_(True)
+    energy = energy_density(features)
+    (gradient,) = torch.autograd.grad(torch.sum(energy), features)
+    return energy.detach().numpy(), gradient.numpy()
+
+
+def check_compiled(compiled, eager, rtol=1e-8, atol=1e-12, unpolarized=False):
+    """
+    Compare energy densities and their gradients of the compiled
+    and the eager module on reference_features
+    """
+    features = reference_features(unpolarized=unpolarized)
+    for reference, value in zip(
+        energy_and_gradient(eager, features),
+        energy_and_gradient(compiled, features),
+    ):
+        if not np.allclose(value, reference, rtol=rtol, atol=atol):
+            return False
+    return True
+
+
+def compile_energy_density(
+    energy_density, name, path_to_model_state_dict, rtol=1e-8, unpolarized=False
+):
+    """
+    Traced and frozen TorchScript version of energy_density, cached on disk
+    by checkpoint content, package sources and torch version. Falls back to
+    energy_density when the compiled graph does not reproduce the eager
+    output within rtol.
+    """
+    checksum = hashlib.md5()
+    with open(path_to_model_state_dict, "rb") as file:
+        checksum.update(file.read())
+    for source in sorted(glob.glob(os.path.join(package_dir, "*.py"))):
+        with open(source, "rb") as file:
+            checksum.update(file.read())
+    checksum = checksum.hexdigest()
+    path = os.path.join(cache_dir, f"{name}_{checksum}_torch{torch.__version__}.pt")
+
+    if os.path.exists(path):
+        compiled = torch.jit.load(path)
+    else:
+        compiled = torch.jit.freeze(
+            torch.jit.trace(
+                energy_density.eval(),
+                (reference_features(64, unpolarized=unpolarized),),
+                check_trace=False,
+            )
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        # Concurrent jobs may compile the same checkpoint; rename is atomic
+        tmp_path = f"{path}.{os.getpid()}"
+        torch.jit.save(compiled, tmp_path)
+        os.replace(tmp_path, path)
+
+    if not check_compiled(
+        compiled, energy_density, rtol=rtol, unpolarized=unpolarized
+    ):
+        # The file is left in place: other jobs share the cache, and a trace
+        # of the same checkpoint, sources and torch would not match either
+        print(f"Compiled {name} does not match eager evaluation, using eager mode")
+        return energy_density
+
+    print(f"Using compiled {name} from {path}")
+    return compiled
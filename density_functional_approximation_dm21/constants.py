@@ -0,0 +1,45 @@
+import numpy as np
+
+# Constants of the PBE tail in the layout of NN_models.true_constants_PBE:
+# beta, gamma, fz20, the PW92 beta1, beta2, beta3, beta4, a and alpha1 of
+# g(k) for k = 0, 1, 2, the LDA exchange factor, and kappa, mu of each spin.
+# The checkpoints were trained with their float32 values
+PBE_CONSTANTS = np.float32(
+    [
+        0.06672455,
+        (1 - np.log(2)) / (np.pi**2),
+        1.709921,
+        7.5957,
+        14.1189,
+        10.357,
+        3.5876,
+        6.1977,
+        3.6231,
+        1.6382,
+        3.3662,
+        0.88026,
+        0.49294,
+        0.62517,
+        0.49671,
+        0.031091,
+        0.015545,
+        0.016887,
+        0.21370,
+        0.20548,
+        0.11125,
+        -3 / 8 * (3 / np.pi) ** (1 / 3) * 4 ** (2 / 3),
+        0.8040,
+        0.2195149727645171,
+        0.8040,
+        0.2195149727645171,
+    ]
+).tolist()
+
+# Regularization of the NN inputs at vanishing density and gradient
+EPS_RHO = 1e-10
+EPS_SIGMA = 1e-30
+S_FACTOR = 1 / (2 * (3 * np.pi**2) ** (1 / 3))
+TAU_TF_FACTOR = 3 / 10 * (3 * np.pi**2) ** (2 / 3)
+
+# Reaction energies are in kcal/mol, calculated energies in Hartree
+HARTREE_TO_KCAL = 627.509
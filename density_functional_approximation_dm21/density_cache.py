@@ -0,0 +1,101 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+from .model_paths import cache_dir
+
+density_cache_path = os.environ.get(
+    "NN_FUNCTIONAL_DENSITY_CACHE", os.path.join(cache_dir, "densities.h5")
+)
+
+
+def density_key(mol):
+    """
+    Hash of what a density matrix depends on besides the method: geometry
+    (Bohr, rounded to 1e-6), elements, charge, spin, basis, ECP and
+    cartesian/spherical functions
+    """
+    description = repr(
+        (
+            [mol.atom_symbol(i) for i in range(mol.natm)],
+            np.round(mol.atom_coords(), 6).tolist(),
+            mol.charge,
+            mol.spin,
+            sorted(mol._basis.items()),
+            sorted(mol._ecp.items()),
+            mol.cart,
+        )
+    )
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+@contextmanager
+def locked_cache(mode, path=density_cache_path):
+    """The cache file opened in mode under an exclusive lock, for parallel jobs"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with h5py.File(path, mode) as file:
+                yield file
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_density(mol, method=None, restricted=None):
+    """
+    Cached converged density matrix of mol: the one of method if present,
+    otherwise the last one stored by any method; None without an entry.
+    restricted=True/False converts it to the (nao, nao)/(2, nao, nao) layout
+    of RKS/UKS.
+    """
+    if not os.path.exists(density_cache_path):
+        return None
+    key = density_key(mol)
+    try:
+        with locked_cache("r") as file:
+            if key not in file:
+                return None
+            group = file[key]
+            if method not in group:
+                method = group.attrs["latest"]
+            dm = group[method][()]
+    except (OSError, KeyError) as E:
+        print(f"Density cache not read: {E}")
+        return None
+
+    print(f"Initial guess: {method} density from {density_cache_path}")
+    if restricted is True and dm.ndim == 3:
+        dm = dm[0] + dm[1]
+    elif restricted is False and dm.ndim == 2:
+        dm = np.stack([dm / 2, dm / 2])
+    return dm
+
+
+def save_density(mol, dm, method):
+    """Stores the converged density matrix dm of mol computed with method"""
+    key = density_key(mol)
+    try:
+        with locked_cache("a") as file:
+            group = file.require_group(key)
+            if method in group:
+                del group[method]
+            group.create_dataset(method, data=np.asarray(dm))
+            group.attrs["latest"] = method
+    except OSError as E:
+        print(f"Density cache not written: {E}")
+
+
+def initial_guess(mf, method=None):
+    """load_density in the layout of mf (RKS or UKS)"""
+    return load_density(mf.mol, method, restricted=not mf.istype("UHF"))
+
+
+def store_converged(mf, method):
+    """save_density of a converged mf"""
+    if mf.converged:
+        save_density(mf.mol, mf.make_rdm1(), method)
@@ -0,0 +1,322 @@
+from optparse import OptionParser
+
+import mpmath
+import numpy as np
+import torch
+from pyscf import dft, gto
+
+from . import xc_formulas
+from .compiled import reference_features
+from .constants import EPS_RHO, EPS_SIGMA
+from .ensemble import grid_densities
+from .NN_models import pbe_parameter_scale
+from .PBE import (
+    analytic_xc,
+    pbe_xc,
+    pbe_xc_and_derivatives,
+    pbe_xc_unpolarized,
+    pbe_xc_unpolarized_and_derivatives,
+)
+from .precision import reference_molecules
+from .SVWN3 import xalpha_xc, xalpha_xc_and_derivatives
+
+# Largest deviation, relative to the largest derivative of each argument,
+# accepted between AnalyticXC and autograd and between NumPy and torch
+TOLERANCE = 1e-8
+# Where AnalyticXC and autograd disagree by more than this, the exact
+# derivatives are computed in mpmath to decide between them
+EXACT_THRESHOLD = TOLERANCE / 100
+
+
+def parameters(npoints, generator, unpolarized=False):
+    """
+    PBE parameters (beta, gamma, kappa_a, mu_a, kappa_b, mu_b), or (beta,
+    gamma, kappa, mu) when unpolarized, within the ranges of the model
+    activations
+    """
+    low = np.array([0.75, 0.2, 0.05, 0.2, 0.05, 0.2])
+    high = np.array([1.25, 2.0, 1.0, 2.0, 1.0, 2.0])
+    scale = pbe_parameter_scale[0].double().numpy()
+    if unpolarized:
+        low, high, scale = low[:4], high[:4], scale[:4]
+    return generator.uniform(low, high, (npoints, len(low))) * scale
+
+
+def reference_cases(npoints=512, seed=0):
+    """
+    {name: (energy, energy_and_derivatives, formula, args)}: the torch
+    functions given to analytic_xc, the xc_formulas function they bind and
+    their float64 arguments on the reference_features points
+    """
+    generator = np.random.default_rng(seed)
+    rho_a, rho_b, sigma_aa, sigma_bb, sigma, _, _ = reference_features(
+        npoints, seed
+    ).numpy()
+    rho, sigma_unpolarized, _ = reference_features(
+        npoints, seed, unpolarized=True
+    ).numpy()
+    sigma_ab = (sigma - sigma_aa - sigma_bb) / 2
+    alpha = generator.uniform(0.5, 1.5, npoints)
+
+    return {
+        "PBE": (
+            pbe_xc,
+            pbe_xc_and_derivatives,
+            xc_formulas.pbe_xc_and_derivatives,
+            [
+                rho_a,
+                rho_b,
+                sigma_aa,
+                sigma_ab,
+                sigma_bb,
+                *parameters(npoints, generator).T,
+            ],
+        ),
+        "PBE unpolarized": (
+            pbe_xc_unpolarized,
+            pbe_xc_unpolarized_and_derivatives,
+            xc_formulas.pbe_xc_unpolarized_and_derivatives,
+            [
+                rho,
+                sigma_unpolarized,
+                *parameters(npoints, generator, unpolarized=True).T,
+            ],
+        ),
+        "XAlpha": (
+            xalpha_xc,
+            xalpha_xc_and_derivatives,
+            xc_formulas.xalpha_xc_and_derivatives,
+            [rho_a + rho_b, alpha],
+        ),
+    }
+
+
+# Converged densities checked on their grids (Angstrom), charge, spin. The H
+# atom has no beta density, so sigma_bb = rho_b = 0 takes the fully
+# polarized branch of F_PBE.
+grid_molecules = {
+    "H2O": reference_molecules["H2O"],
+    "OH": reference_molecules["OH"],
+    "H": ("H 0 0 0", 0, 1),
+}
+
+
+def grid_variables(name, basis="def2-svp"):
+    """
+    (rho_a, rho_b, sigma_aa, sigma_ab, sigma_bb) of the converged PBE density
+    of grid_molecules[name] on every point of its grid, unscreened
+    """
+    atom, charge, spin = grid_molecules[name]
+    mol = gto.M(atom=atom, basis=basis, charge=charge, spin=spin, verbose=0)
+    mf = dft.RKS(mol) if spin == 0 else dft.UKS(mol)
+    mf.xc = "PBE"
+    mf.kernel()
+
+    dm = mf.make_rdm1()
+    if spin == 0:
+        # Both spin channels carry half of the closed-shell density
+        dm = np.stack([dm / 2, dm / 2])
+    rho_a, rho_b = np.concatenate(
+        [rho[:, :4] for rho, _ in grid_densities(mf, dm)], axis=2
+    )
+    return (
+        rho_a[0],
+        rho_b[0],
+        np.sum(rho_a[1:] ** 2, axis=0),
+        np.sum(rho_a[1:] * rho_b[1:], axis=0),
+        np.sum(rho_b[1:] ** 2, axis=0),
+    )
+
+
+def grid_cases(seed=0):
+    """
+    reference_cases on the grids of converged molecular densities: PBE and
+    XAlpha of OH and H, unpolarized PBE of H2O. The OH and H2O tails fall
+    below EPS_RHO, and the H atom has rho_b = sigma_bb = 0, so the
+    regularized small-density branches are checked where they are met.
+    """
+    generator = np.random.default_rng(seed)
+    cases = {}
+    for name in ("OH", "H"):
+        variables = grid_variables(name)
+        npoints = len(variables[0])
+        cases[f"PBE {name}"] = (
+            pbe_xc,
+            pbe_xc_and_derivatives,
+            xc_formulas.pbe_xc_and_derivatives,
+            [*variables, *parameters(npoints, generator).T],
+        )
+        cases[f"XAlpha {name}"] = (
+            xalpha_xc,
+            xalpha_xc_and_derivatives,
+            xc_formulas.xalpha_xc_and_derivatives,
+            [variables[0] + variables[1], generator.uniform(0.5, 1.5, npoints)],
+        )
+
+    rho_a, _, sigma_aa, _, _ = grid_variables("H2O")
+    cases["PBE unpolarized H2O"] = (
+        pbe_xc_unpolarized,
+        pbe_xc_unpolarized_and_derivatives,
+        xc_formulas.pbe_xc_unpolarized_and_derivatives,
+        [
+            2 * rho_a,
+            4 * sigma_aa,
+            *parameters(len(rho_a), generator, unpolarized=True).T,
+        ],
+    )
+    return cases
+
+
+class MPMath:
+    """The elementwise functions xc_formulas takes as xp, for mpmath scalars"""
+
+    sqrt = staticmethod(mpmath.sqrt)
+    log1p = staticmethod(mpmath.log1p)
+    expm1 = staticmethod(mpmath.expm1)
+
+    @staticmethod
+    def where(condition, x, y):
+        return x if condition else y
+
+
+def exact_derivatives(energy, point, direction):
+    """
+    First derivatives of the xc_formulas energy at one point and its second
+    derivatives along direction, by central differences in 120-digit mpmath.
+    The steps stay below xc_formulas.EPS, so no branch of F_PBE is crossed.
+    """
+    with mpmath.workdps(120):
+        step, outer_step = mpmath.mpf("1e-40"), mpmath.mpf("1e-30")
+        point = [mpmath.mpf(float(x)) for x in point]
+
+        def gradient(shift):
+            shifted = [x + shift * float(v) for x, v in zip(point, direction)]
+            derivatives = []
+            for k in range(len(shifted)):
+                up, down = list(shifted), list(shifted)
+                up[k] += step
+                down[k] -= step
+                derivatives.append(
+                    (energy(MPMath, *up) - energy(MPMath, *down)) / (2 * step)
+                )
+            return derivatives
+
+        first = gradient(0)
+        second = [
+            (up - down) / (2 * outer_step)
+            for up, down in zip(gradient(outer_step), gradient(-outer_step))
+        ]
+        return [float(d) for d in first], [float(d) for d in second]
+
+
+def arbitrate(energy, args, directions, analytic, reference):
+    """
+    reference with the exact_derivatives at the points where analytic
+    deviates from it beyond EXACT_THRESHOLD. Plain autograd loses digits
+    where the PBE H terms cancel, e.g. in the tail of the H atom.
+    """
+    deviation = np.max(
+        [
+            np.abs(value - expected) / np.max(np.abs(expected))
+            for values, references in zip(analytic, reference)
+            for value, expected in zip(values, references)
+        ],
+        axis=0,
+    )
+    points = np.flatnonzero(deviation > EXACT_THRESHOLD)
+    reference = [[d.copy() for d in derivatives] for derivatives in reference]
+    for i in points:
+        exact = exact_derivatives(
+            energy, [arg[i] for arg in args], [v[i] for v in directions]
+        )
+        for derivatives, values in zip(reference, exact):
+            for d, value in zip(derivatives, values):
+                d[i] = value
+    return reference, len(points)
+
+
+def relative_deviation(values, references):
+    """Largest deviation of each value relative to the largest reference"""
+    return max(
+        float(np.max(np.abs(value - reference)) / np.max(np.abs(reference)))
+        for value, reference in zip(values, references)
+    )
+
+
+def autograd_derivatives(energy, energy_and_derivatives, args, directions, analytic):
+    """
+    First derivatives of the summed energy and its second derivatives along
+    directions, through AnalyticXC or through plain autograd of energy
+    """
+    inputs = [torch.tensor(arg).requires_grad_(True) for arg in args]
+    if analytic:
+        exc = analytic_xc(energy, energy_and_derivatives, *inputs)
+    else:
+        exc = energy(*inputs)
+    first = torch.autograd.grad(exc.sum(), inputs, create_graph=True)
+    projection = sum(torch.sum(d * v) for d, v in zip(first, directions))
+    second = torch.autograd.grad(projection, inputs)
+    return (
+        [d.detach().numpy() for d in first],
+        [d.numpy() for d in second],
+    )
+
+
+def derivative_deviations(npoints=512, seed=0, grids=True):
+    """
+    {name: (first, second, numpy)} relative deviations of the AnalyticXC
+    first and second derivatives from plain autograd (see arbitrate), and of
+    the NumPy
+    energy and derivatives from the torch ones, on the reference_features
+    points and (grids) on the molecular grids of grid_cases
+    """
+    generator = np.random.default_rng(seed + 1)
+    cases = reference_cases(npoints, seed)
+    if grids:
+        cases.update(grid_cases(seed))
+    deviations = {}
+    for name, (energy, energy_and_derivatives, formula, args) in cases.items():
+        directions = [
+            torch.tensor(generator.normal(size=len(args[0]))) for _ in args
+        ]
+        analytic = autograd_derivatives(
+            energy, energy_and_derivatives, args, directions, analytic=True
+        )
+        reference = autograd_derivatives(
+            energy, energy_and_derivatives, args, directions, analytic=False
+        )
+        reference, exact_points = arbitrate(
+            energy.func, args, directions, analytic, reference
+        )
+
+        energy_np, derivatives_np = formula(np, *args)
+        energy_torch, derivatives_torch = formula(
+            torch, *(torch.tensor(arg) for arg in args)
+        )
+        deviations[name] = (
+            relative_deviation(analytic[0], reference[0]),
+            relative_deviation(analytic[1], reference[1]),
+            relative_deviation(
+                [energy_np, *derivatives_np],
+                [t.numpy() for t in (energy_torch, *derivatives_torch)],
+            ),
+        )
+        print(
+            f"{name}: first {deviations[name][0]:.1e}, "
+            f"second {deviations[name][1]:.1e}, NumPy {deviations[name][2]:.1e}"
+            + (f" ({exact_points} points exact)" if exact_points else "")
+        )
+    return deviations
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--Points", type=int, default=4096)
+    parser.add_option("--Seed", type=int, default=0)
+
+    (Opts, args) = parser.parse_args()
+
+    deviations = derivative_deviations(Opts.Points, Opts.Seed)
+    failed = [name for name, values in deviations.items() if max(values) > TOLERANCE]
+    if failed:
+        raise SystemExit(f"Deviations above {TOLERANCE:.0e}: {', '.join(failed)}")
@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+import dftd3.pyscf as disp
+import numpy as np
+
+from .density_cache import locked_cache
+from .model_paths import cache_dir
+
+dispersion_store_path = os.environ.get(
+    "NN_FUNCTIONAL_DISPERSION_STORE", os.path.join(cache_dir, "dispersions.h5")
+)
+
+# D3 parametrizations of the benchmark: PBE0 for the NN functionals and
+# XAlpha, PBE for PBE
+PARAMETRIZATIONS = (("PBE0", "d3bj"), ("PBE", "d3bj"))
+
+
+def geometry_key(mol):
+    """Hash of the elements and the geometry (Bohr, rounded to 1e-6) of mol"""
+    description = repr(
+        (
+            [mol.atom_symbol(i) for i in range(mol.natm)],
+            np.round(mol.atom_coords(), 6).tolist(),
+        )
+    )
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def parametrization_name(xc, version):
+    return f"{xc}-{version}"
+
+
+def stored_dispersions(keys):
+    """{key: {parametrization: energy}} of the geometry keys in the store"""
+    stored = {key: {} for key in keys}
+    if not os.path.exists(dispersion_store_path):
+        return stored
+    try:
+        with locked_cache("r", dispersion_store_path) as file:
+            for key in keys:
+                if key in file:
+                    stored[key].update(
+                        (name, float(energy))
+                        for name, energy in file[key].attrs.items()
+                    )
+    except OSError as E:
+        print(f"Dispersion store not read: {E}")
+    return stored
+
+
+def write_dispersions(energies):
+    """Adds {key: {parametrization: energy}} to the store"""
+    try:
+        with locked_cache("a", dispersion_store_path) as file:
+            for key, parametrizations in energies.items():
+                file.require_group(key).attrs.update(parametrizations)
+    except OSError as E:
+        print(f"Dispersion store not written: {E}")
+
+
+def compute_dispersions(molecules, parametrizations=PARAMETRIZATIONS):
+    """
+    [{parametrization: energy}] of every molecule: stored energies are read,
+    missing ones computed with dftd3 and written back in one transaction
+    """
+    keys = [geometry_key(mol) for mol in molecules]
+    stored = stored_dispersions(set(keys))
+
+    computed = {}
+    for mol, key in zip(molecules, keys):
+        for xc, version in parametrizations:
+            name = parametrization_name(xc, version)
+            if name not in stored[key]:
+                energy = disp.DFTD3Dispersion(mol, xc=xc, version=version).kernel()[0]
+                stored[key][name] = computed.setdefault(key, {})[name] = energy
+    if computed:
+        write_dispersions(computed)
+    return [stored[key] for key in keys]
+
+
+def dispersion_energy(mol, xc="PBE0", version="d3bj"):
+    """D3 energy (Hartree) of mol with the parametrization of xc, from the store"""
+    energies = compute_dispersions([mol], [(xc, version)])[0]
+    return energies[parametrization_name(xc, version)]
@@ -1,434 +1,377 @@
-import os
+from functools import lru_cache
 
 import numpy as np
 import torch
 
+from .compiled import compile_energy_density
+from .constants import EPS_RHO, EPS_SIGMA, S_FACTOR, TAU_TF_FACTOR
+from .libxc_format import (
+    DENSITY_THRESHOLD,
+    MAX_MEMORY,
+    BlockedEvaluation,
+    eval_xc_in_blocks,
+    libxc_variables_polarized,
+)
+from .model_paths import (
+    MODEL_CACHE_SIZE,
+    dir_path,
+    omega_str_list,
+    relative_path_to_model_state_dict,
+)
 from .NN_models import NN_PBE_model, NN_PBE_star_model, NN_XALPHA_model
-from .PBE import F_PBE
-from .SVWN3 import F_XALPHA
+from .PBE import F_PBE, F_PBE_unpolarized
+from .SVWN3 import F_XALPHA, F_XALPHA_unpolarized
+from .threads import thread_budget
 
 torch.set_default_tensor_type(torch.DoubleTensor)
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-relative_path_to_model_state_dict = {
-    "NN_PBE": "checkpoints/NN_PBE/state_dict.pth",
-    "NN_XALPHA": "checkpoints/NN_XALPHA/state_dict.pth",
-}
-
-omega_str_list = ["0", "0076", "067", "18", "33", "50", "67", "82", "93", "99"]
-
-relative_path_to_model_state_dict.update(
-    {
-        f"NN_XALPHA_{omega}": f"checkpoints/NN_XALPHA/state_dict_0.{omega}.pth"
-        for omega in omega_str_list
-    }
-)
-relative_path_to_model_state_dict.update(
-    {
-        f"NN_PBE_{omega}": f"checkpoints/NN_PBE/state_dict_0.{omega}.pth"
-        for omega in omega_str_list
-    }
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_XALPHA_100": f"checkpoints/NN_XALPHA/state_dict_1.pth"}
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_PBE_100": f"checkpoints/NN_PBE/state_dict_1.pth"}
-)
-relative_path_to_model_state_dict.update(
-    {f"NN_PBE_star": f"checkpoints/NN_PBE/state_dict_*.pth"}
-)
-
 nn_model = {
     "NN_PBE": NN_PBE_model,
     "NN_XALPHA": NN_XALPHA_model,
     "NN_PBE_star": NN_PBE_star_model,
 }
-
-omega_str_list.append("100")
-
 nn_model.update({f"NN_XALPHA_{omega}": NN_XALPHA_model for omega in omega_str_list})
 nn_model.update({f"NN_PBE_{omega}": NN_PBE_model for omega in omega_str_list})
 
+# Precision of the network; densities, F_PBE/F_XALPHA and derivatives stay float64
+precision_dtype = {
+    "float64": torch.float64,
+    "float32": torch.float32,
+}
 
-class NN_FUNCTIONAL:
-
-    def __init__(self, name):
-        path_to_model_state_dict = (
-            dir_path + "/" + relative_path_to_model_state_dict[name]
-        )
-        model = nn_model[name]()
-        print(path_to_model_state_dict)
-        model.load_state_dict(
-            torch.load(path_to_model_state_dict, map_location=torch.device("cpu"))
-        )
-        model.eval()
-        self.name = name
-        self.model = model
+# Peak memory (bytes) held per grid point by one forward/backward pass of eval_xc
+memory_per_grid_point = {
+    "PBE": 36e3,
+    "XALPHA": 10e3,
+}
 
-    def create_features_from_rhos(self, features, device):
-        rho_only_a, grad_a_x, grad_a_y, grad_a_z, _, tau_a = torch.unsqueeze(
-            features["rho_a"], dim=1
-        )
-        rho_only_b, grad_b_x, grad_b_y, grad_b_z, _, tau_b = torch.unsqueeze(
-            features["rho_b"], dim=1
-        )
 
-        norm_grad_a = grad_a_x**2 + grad_a_y**2 + grad_a_z**2
-        norm_grad_b = grad_b_x**2 + grad_b_y**2 + grad_b_z**2
-
-        grad_x = grad_a_x + grad_b_x
-        grad_y = grad_a_y + grad_b_y
-        grad_z = grad_a_z + grad_b_z
-        norm_grad = grad_x**2 + grad_y**2 + grad_z**2
-
-        keys = [
-            "rho_a",
-            "rho_b",
-            "norm_grad_a",
-            "norm_grad",
-            "norm_grad_b",
-            "tau_a",
-            "tau_b",
-        ]
-        values = [
-            rho_only_a,
-            rho_only_b,
-            norm_grad_a,
-            norm_grad,
-            norm_grad_b,
-            tau_a,
-            tau_b,
+# Rows of the (7, n) features in feature_dict terms
+feature_keys = [
+    "rho_a",
+    "rho_b",
+    "norm_grad_a",
+    "norm_grad_b",
+    "norm_grad",
+    "tau_a",
+    "tau_b",
+]
+
+
+def nn_inputs(features):
+    """
+    Contiguous (n, 7) NN inputs (rho_a^(1/3), rho_b^(1/3), s_a, s, s_b,
+    alpha_a - 1, alpha_b - 1) from the (7, n) features. The cube roots of
+    the spin densities give their 4/3 and 5/3 powers.
+    """
+    rho_a, rho_b, grad_a, grad_b, grad, tau_a, tau_b = features
+    rho_a = rho_a + EPS_RHO
+    rho_b = rho_b + EPS_RHO
+    cbrt_a = rho_a ** (1 / 3)
+    cbrt_b = rho_b ** (1 / 3)
+    rho_a_43 = rho_a * cbrt_a
+    rho_b_43 = rho_b * cbrt_b
+
+    return torch.stack(
+        [
+            cbrt_a,
+            cbrt_b,
+            torch.sqrt(grad_a + EPS_SIGMA) * S_FACTOR / rho_a_43,
+            torch.sqrt(grad + EPS_SIGMA)
+            * S_FACTOR
+            / (rho_a + rho_b - EPS_RHO) ** (4 / 3),
+            torch.sqrt(grad_b + EPS_SIGMA) * S_FACTOR / rho_b_43,
+            (tau_a - grad_a / (8 * rho_a)) / (TAU_TF_FACTOR * rho_a_43 * cbrt_a) - 1,
+            (tau_b - grad_b / (8 * rho_b)) / (TAU_TF_FACTOR * rho_b_43 * cbrt_b) - 1,
+        ],
+        dim=1,
+    )
+
+
+def unpolarized_nn_inputs(features):
+    """
+    nn_inputs of a closed shell from the (3, n) libxc variables
+    (rho, sigma, tau): each spin channel is computed once and used twice
+    """
+    rho, sigma, tau = features
+    rho_s = rho / 2 + EPS_RHO
+    sigma_s = sigma / 4
+    cbrt = rho_s ** (1 / 3)
+    rho_43 = rho_s * cbrt
+
+    s_s = torch.sqrt(sigma_s + EPS_SIGMA) * S_FACTOR / rho_43
+    s = torch.sqrt(sigma + EPS_SIGMA) * S_FACTOR / (rho + EPS_RHO) ** (4 / 3)
+    alpha = (tau / 2 - sigma_s / (8 * rho_s)) / (TAU_TF_FACTOR * rho_43 * cbrt) - 1
+
+    return torch.stack([cbrt, cbrt, s_s, s, s_s, alpha, alpha], dim=1)
+
+
+class XCEnergyDensity(torch.nn.Module):
+    """
+    XC energy per particle from the (7, n) features
+    (rho_a, rho_b, norm_grad_a, norm_grad_b, norm_grad, tau_a, tau_b):
+    the NN input transform, the network and the PBE/XAlpha tail in one module
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.dtype = next(model.parameters()).dtype
+
+    def inputs(self, features):
+        """Network inputs, which depend on the features only"""
+        return torch.tanh(nn_inputs(features))
+
+    def energy(self, features, inputs):
+        rho_a, rho_b, grad_a, grad_b, grad, _, _ = features
+        grad_ab = (grad - grad_a - grad_b) / 2
+
+        constants = self.model(inputs.to(self.dtype)).double()
+
+        functional_densities = torch.stack([rho_a, rho_b], dim=1)
+        functional_gradients = torch.stack([grad_a, grad_ab, grad_b], dim=1)
+
+        if self.model.DFT == "PBE":
+            return F_PBE(functional_densities, functional_gradients, constants)
+        return F_XALPHA(functional_densities, constants)
+
+    def forward(self, features):
+        return self.energy(features, self.inputs(features))
+
+
+class UnpolarizedXCEnergyDensity(XCEnergyDensity):
+    """
+    XCEnergyDensity of a closed shell (rho_a = rho_b) from the (3, n) libxc
+    variables (rho, sigma, tau): no spin-symmetrization or second exchange
+    pass in the network and the z = 0 forms of F_PBE/F_XALPHA
+    """
+
+    def inputs(self, features):
+        return torch.tanh(unpolarized_nn_inputs(features))
+
+    def energy(self, features, inputs):
+        rho, sigma, _ = features
+
+        constants = self.model.forward_unpolarized(inputs.to(self.dtype)).double()
+
+        if self.model.DFT == "PBE":
+            return F_PBE_unpolarized(rho, sigma, constants)
+        return F_XALPHA_unpolarized(rho, constants)
+
+
+def features_from_rho(rho, spin):
+    """
+    Features of the energy density modules from PySCF rho ((5, n) for spin 0,
+    (2, 5, n) for spin 1): (rho, sigma, tau) (3, n) for spin 0 and the seven
+    feature_keys (7, n) for spin 1
+    """
+    rho = torch.as_tensor(rho, dtype=torch.float64)
+    if spin == 0:
+        return torch.stack([rho[0], torch.sum(rho[1:4] ** 2, dim=0), rho[4]])
+
+    rho_a, rho_b = rho
+    grad = rho_a[1:4] + rho_b[1:4]
+    return torch.stack(
+        [
+            rho_a[0],
+            rho_b[0],
+            torch.sum(rho_a[1:4] ** 2, dim=0),
+            torch.sum(rho_b[1:4] ** 2, dim=0),
+            torch.sum(grad**2, dim=0),
+            rho_a[4],
+            rho_b[4],
         ]
+    )
+
+
+def path_to_model_state_dict(name):
+    return dir_path + "/" + relative_path_to_model_state_dict[name]
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_model(name, precision="float64"):
+    """
+    Model with the weights of checkpoint name in evaluation mode. Loaded once
+    per process and precision and shared by all NN_FUNCTIONAL(name) instances.
+    """
+    model = nn_model[name]()
+    model.load_state_dict(
+        torch.load(path_to_model_state_dict(name), map_location=torch.device("cpu"))
+    )
+    model.to(precision_dtype[precision])
+    model.eval()
+    return model
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_compiled_energy_density(name, precision="float64", unpolarized=False):
+    model = load_model(name, precision)
+    if unpolarized:
+        energy_density = UnpolarizedXCEnergyDensity(model)
+        tag = f"{name}_unpolarized"
+    else:
+        energy_density = XCEnergyDensity(model)
+        tag = name
+    if precision != "float64":
+        tag = f"{tag}_{precision}"
+    return compile_energy_density(
+        energy_density,
+        tag,
+        path_to_model_state_dict(name),
+        rtol=1e-8 if precision == "float64" else 1e-5,
+        unpolarized=unpolarized,
+    )
+
+
+class NN_FUNCTIONAL(BlockedEvaluation):
+
+    memory_per_grid_point = memory_per_grid_point
+
+    def __init__(
+        self,
+        name,
+        max_memory=MAX_MEMORY,
+        compiled=False,
+        precision="float64",
+        density_threshold=DENSITY_THRESHOLD,
+        num_threads=None,
+    ):
+        model = load_model(name, precision)
+        self.name = name
+        self.model = model
+        self.max_memory = max_memory
+        # torch threads used inside eval_xc, None keeps the global setting
+        self.num_threads = num_threads
+        self.density_threshold = density_threshold
+        self.total_points = 0
+        self.skipped_points = 0
+        self.precision = precision
+        if compiled:
+            self.energy_density = load_compiled_energy_density(name, precision)
+            self.unpolarized_energy_density = load_compiled_energy_density(
+                name, precision, unpolarized=True
+            )
+        else:
+            self.energy_density = XCEnergyDensity(model)
+            self.unpolarized_energy_density = UnpolarizedXCEnergyDensity(model)
 
-        feature_dict = dict()
-        for key, value in zip(keys, values):
-            feature_dict[key] = value
-            feature_dict[key].requires_grad = True
-
-        feature_dict["norm_grad_ab"] = (
-            feature_dict["norm_grad"]
-            - feature_dict["norm_grad_a"]
-            - feature_dict["norm_grad_b"]
-        ) / 2
-
-        return feature_dict
-
-    def create_features_from_libxc(self, features):
-        rho = features["rho"]
-        sigma = features["sigma"]
-        tau = features["tau"]
-
-        feature_dict = dict()
-
-        feature_dict["rho_a"] = torch.tensor(rho / 2, dtype=torch.float64).view(1, -1)
-        feature_dict["rho_b"] = torch.tensor(rho / 2, dtype=torch.float64).view(1, -1)
-        feature_dict["tau_a"] = torch.tensor(tau / 2, dtype=torch.float64).view(1, -1)
-        feature_dict["tau_b"] = torch.tensor(tau / 2, dtype=torch.float64).view(1, -1)
-        feature_dict["norm_grad"] = torch.tensor(sigma, dtype=torch.float64).view(1, -1)
-        feature_dict["norm_grad_a"] = torch.tensor(sigma / 4, dtype=torch.float64).view(
-            1, -1
-        )
-        feature_dict["norm_grad_b"] = torch.tensor(sigma / 4, dtype=torch.float64).view(
-            1, -1
-        )
+    def __call__(self, features, device, mode=None):
+        """
+        (local_xc, vxc, feature_dict) of features: libxc's closed-shell "rho",
+        "sigma" and "tau" with mode set, otherwise the (6, n) PySCF spin
+        densities "rho_a" and "rho_b" (rows rho, grad_x, grad_y, grad_z,
+        laplacian, tau). feature_dict holds the (1, n) feature_keys as leaves
+        that require grad, and norm_grad_ab.
+        """
+        if mode:
+            # Each spin gets half of rho, tau and of a gradient with
+            # |grad rho|^2 = sigma
+            rho, sigma, tau = (
+                np.asarray(features[key], dtype=np.float64)
+                for key in ("rho", "sigma", "tau")
+            )
+            zeros = np.zeros_like(rho)
+            rho_s = np.stack([rho, np.sqrt(sigma), zeros, zeros, tau]) / 2
+            rho = np.stack([rho_s, rho_s])
+        else:
+            rho = torch.stack(
+                [torch.as_tensor(features[key]) for key in ("rho_a", "rho_b")]
+            )[:, [0, 1, 2, 3, 5]]
+
+        feature_dict = {
+            key: row.view(1, -1).clone().requires_grad_()
+            for key, row in zip(feature_keys, features_from_rho(rho, 1))
+        }
         feature_dict["norm_grad_ab"] = (
             feature_dict["norm_grad"]
             - feature_dict["norm_grad_a"]
             - feature_dict["norm_grad_b"]
         ) / 2
 
-        return feature_dict
-
-    def __call__(self, features, device, mode=None):
-
-        torch.autograd.set_detect_anomaly(True)
-
-        # Get features for NN and functional
-        if mode:
-            feature_dict = self.create_features_from_libxc(features)
-        else:
-            feature_dict = self.create_features_from_rhos(features, device)
-
-        keys = [
-            "rho_a",
-            "rho_b",
-            "norm_grad_a",
-            "norm_grad",
-            "norm_grad_b",
-            "tau_a",
-            "tau_b",
-            "norm_grad_ab",
-        ]
-
-        eps_rho = 1e-27
-        eps_sigma = eps_rho ** (8 / 3)
-
-        nn_inputs = torch.cat([feature_dict[key] for key in keys[:7]], dim=0).T
-        rho_a_inp = feature_dict["rho_a"] + eps_rho
-        rho_b_inp = feature_dict["rho_b"] + eps_rho
-        grad_a_inp = feature_dict["norm_grad_a"]
-        grad_b_inp = feature_dict["norm_grad_b"]
-        grad_inp = feature_dict["norm_grad"]
-        tau_a_inp = feature_dict["tau_a"]
-        tau_b_inp = feature_dict["tau_b"]
-        nn_inputs[:, 0] = rho_a_inp ** (1 / 3)
-        nn_inputs[:, 1] = rho_b_inp ** (1 / 3)
-        nn_inputs[:, 2] = (
-            torch.sqrt(grad_a_inp + eps_sigma)
-            / rho_a_inp ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
-        )
-        nn_inputs[:, 3] = (
-            torch.sqrt(grad_inp + eps_sigma)
-            / (rho_a_inp + rho_b_inp - eps_rho) ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
+        vxc = self.energy_density(
+            torch.cat([feature_dict[key] for key in feature_keys], dim=0)
         )
-        nn_inputs[:, 4] = (
-            torch.sqrt(grad_b_inp + eps_sigma)
-            / rho_b_inp ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
-        )
-        tau_tf_alpha = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * (rho_a_inp) ** (5 / 3)
-        tau_tf_beta = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * (rho_b_inp) ** (5 / 3)
-        tau_w_alpha = grad_a_inp / (8 * rho_a_inp)
-        tau_w_beta = grad_b_inp / (8 * rho_b_inp)
-        nn_inputs[:, 5] = (tau_a_inp - tau_w_alpha) / tau_tf_alpha - 1
-        nn_inputs[:, 6] = (tau_b_inp - tau_w_beta) / tau_tf_beta - 1
-
-        constants = self.model(torch.tanh(nn_inputs))
-
-        functional_densities = torch.cat(
-            [feature_dict[key] for key in keys[:2]], dim=0
-        ).T
-
-        functional_gradients = torch.cat(
-            [
-                feature_dict["norm_grad_a"],
-                feature_dict["norm_grad_ab"],
-                feature_dict["norm_grad_b"],
-            ],
-            dim=0,
-        ).T
-
-        if "NN_PBE" in self.name:
-            vxc = F_PBE(functional_densities, functional_gradients, constants, device)
-        elif "NN_XALPHA" in self.name:
-            vxc = F_XALPHA(functional_densities, constants)
-        else:
-            raise NameError(f"Invalid functional name: {self.name}")
-
         local_xc = vxc * (feature_dict["rho_a"] + feature_dict["rho_b"])
 
         return local_xc, vxc, feature_dict
 
-    def torch_grad(self, outputs, inputs):
+    def torch_grad(self, outputs, inputs, create_graph=False, retain_graph=None):
         grads = torch.autograd.grad(
             outputs,
             inputs,
-            create_graph=True,
+            create_graph=create_graph,
+            retain_graph=retain_graph,
             only_inputs=True,
+            materialize_grads=True,
         )
         return grads
 
-    def eval_xc(
-        self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
-    ):
-
+    def eval_xc_block(self, rho, spin, deriv=1):
+        """
+        Energy density and its derivatives on one block of grid points of
+        PySCF rho ((5, n) for spin 0, (2, 5, n) for spin 1, rows rho, grad_x,
+        grad_y, grad_z, tau). Returns exc (n,), the first derivatives (k, n)
+        and the second derivatives (k, k, n) when deriv > 1 with respect to
+        the k libxc variables.
+        """
+        features = features_from_rho(rho, spin)
         if spin == 0:
-            rho_only_a, grad_a_x, grad_a_y, grad_a_z, tau_a = torch.unsqueeze(
-                torch.tensor(rho / 2, dtype=torch.float64), dim=1
-            )
-            rho_only_b, grad_b_x, grad_b_y, grad_b_z, tau_b = torch.unsqueeze(
-                torch.tensor(rho / 2, dtype=torch.float64), dim=1
-            )
+            # Closed shell: the libxc variables (rho, sigma, tau) are the features
+            energy_density = self.unpolarized_energy_density
+            variables = None
         else:
-            rho_only_a, grad_a_x, grad_a_y, grad_a_z, tau_a = torch.unsqueeze(
-                torch.tensor(rho[0], dtype=torch.float64), dim=1
-            )
-            rho_only_b, grad_b_x, grad_b_y, grad_b_z, tau_b = torch.unsqueeze(
-                torch.tensor(rho[1], dtype=torch.float64), dim=1
-            )
-
-        norm_grad_a = grad_a_x**2 + grad_a_y**2 + grad_a_z**2
-        norm_grad_b = grad_b_x**2 + grad_b_y**2 + grad_b_z**2
-        grad_x = grad_a_x + grad_b_x
-        grad_y = grad_a_y + grad_b_y
-        grad_z = grad_a_z + grad_b_z
-        norm_grad = grad_x**2 + grad_y**2 + grad_z**2
-        keys = [
-            "rho_a",
-            "rho_b",
-            "norm_grad_a",
-            "norm_grad",
-            "norm_grad_b",
-            "tau_a",
-            "tau_b",
-        ]
-        values = [
-            rho_only_a,
-            rho_only_b,
-            norm_grad_a,
-            norm_grad,
-            norm_grad_b,
-            tau_a,
-            tau_b,
-        ]
-        feature_dict = dict(zip(keys, values))
-
-        for key in feature_dict:
-            feature_dict[key].requires_grad = True
-
-        feature_dict["norm_grad_ab"] = (
-            feature_dict["norm_grad"]
-            - feature_dict["norm_grad_a"]
-            - feature_dict["norm_grad_b"]
-        ) / 2
-
-        keys = [
-            "rho_a",
-            "rho_b",
-            "norm_grad_a",
-            "norm_grad",
-            "norm_grad_b",
-            "tau_a",
-            "tau_b",
-            "norm_grad_ab",
-        ]
-
-        nn_inputs = torch.cat([feature_dict[key] for key in keys[:7]], dim=0).T
-
-        eps_rho = 1e-10
-        eps_sigma = 1e-30
-
-        rho_a_inp = feature_dict["rho_a"] + eps_rho
-        rho_b_inp = feature_dict["rho_b"] + eps_rho
-
-        grad_a_inp = feature_dict["norm_grad_a"]
-        grad_b_inp = feature_dict["norm_grad_b"]
-        grad_inp = feature_dict["norm_grad"]
-        tau_a_inp = feature_dict["tau_a"]
-        tau_b_inp = feature_dict["tau_b"]
-        nn_inputs[:, 0] = rho_a_inp ** (1 / 3)
-        nn_inputs[:, 1] = rho_b_inp ** (1 / 3)
-        nn_inputs[:, 2] = (
-            torch.sqrt(grad_a_inp + eps_sigma)
-            / rho_a_inp ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
-        )
-        nn_inputs[:, 3] = (
-            torch.sqrt(grad_inp + eps_sigma)
-            / (rho_a_inp + rho_b_inp - eps_rho) ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
-        )
-        nn_inputs[:, 4] = (
-            torch.sqrt(grad_b_inp + eps_sigma)
-            / rho_b_inp ** (4 / 3)
-            / (3 * np.pi**2) ** (1 / 3)
-            / 2
-        )
-        tau_tf_alpha = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * (rho_a_inp) ** (5 / 3)
-        tau_tf_beta = 3 / 10 * (3 * np.pi**2) ** (2 / 3) * (rho_b_inp) ** (5 / 3)
-        tau_w_alpha = grad_a_inp / (8 * rho_a_inp)
-        tau_w_beta = grad_b_inp / (8 * rho_b_inp)
-        nn_inputs[:, 5] = (tau_a_inp - tau_w_alpha) / tau_tf_alpha - 1
-        nn_inputs[:, 6] = (tau_b_inp - tau_w_beta) / tau_tf_beta - 1
-
-        constants = self.model(torch.tanh(nn_inputs))
-
-        functional_densities = torch.cat(
-            [feature_dict[key] for key in keys[:2]], dim=0
-        ).T
-        functional_gradients = torch.cat(
+            energy_density = self.energy_density
+            variables = torch.tensor(libxc_variables_polarized, dtype=torch.float64)
+        features.requires_grad = deriv > 0
+
+        vxc = energy_density(features)
+        density = features[0] if spin == 0 else features[0] + features[1]
+        local_xc = vxc * density
+
+        unweighted_xc = torch.sum(local_xc)
+        exc = vxc.detach().cpu().numpy()
+        if deriv == 0:
+            return exc, None, None
+
+        def libxc_derivative(grads):
+            return grads if variables is None else variables @ grads
+
+        # One reverse pass over all features; the graph of this pass is
+        # kept only when second derivatives are requested
+        (grads,) = self.torch_grad(unweighted_xc, [features], create_graph=deriv > 1)
+        first = libxc_derivative(grads)
+        if deriv == 1:
+            return exc, first.detach().cpu().numpy(), None
+
+        # Grid points are independent, so the gradient of the summed first
+        # derivative along each libxc variable gives one Hessian column per point
+        second = torch.stack(
             [
-                feature_dict["norm_grad_a"],
-                feature_dict["norm_grad_ab"],
-                feature_dict["norm_grad_b"],
-            ],
-            dim=0,
-        ).T
-
-        if "PBE" in self.name:
-            vxc = F_PBE(functional_densities, functional_gradients, constants, "cpu")
-        else:
-            vxc = F_XALPHA(functional_densities, constants)
-
-        local_xc = vxc * (feature_dict["rho_a"] + feature_dict["rho_b"])
-
-        unweighted_xc = torch.sum(local_xc, dim=1)
-
-        vrho = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc, [feature_dict["rho_a"], feature_dict["rho_b"]]
-                )
-            )
-            .detach()
-            .cpu()
-            .numpy()
-        )
-
-        vsigma = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc,
-                    [
-                        feature_dict["norm_grad_a"],
-                        feature_dict["norm_grad_b"],
-                        feature_dict["norm_grad"],
-                    ],
-                )
-            )
-            .detach()
-            .cpu()
-            .numpy()
-        )
-        vtau = (
-            torch.stack(
-                self.torch_grad(
-                    unweighted_xc, [feature_dict["tau_a"], feature_dict["tau_b"]]
+                libxc_derivative(
+                    self.torch_grad(
+                        torch.sum(first[i]),
+                        [features],
+                        retain_graph=i < len(first) - 1,
+                    )[0]
                 )
-            )
-            .detach()
-            .cpu()
-            .numpy()
+                for i in range(len(first))
+            ],
+            dim=1,
         )
 
-        if spin == 0:
-            vxc_0 = (vrho[0][0, :] + vrho[1][0, :]) / 2.0
-            vxc_1 = vsigma[0][0, :] / 4.0 + vsigma[1][0, :] / 4.0 + vsigma[2][0, :]
-            vxc_3 = (vtau[0][0, :] + vtau[1][0, :]) / 2.0
-            vxc_2 = np.zeros_like(vxc_3)
-
-        else:
-            vxc_0 = np.stack([vrho[0][0, :], vrho[1][0, :]], axis=1)
-            vxc_1 = np.stack(
-                [
-                    vsigma[0][0, :] + vsigma[2][0, :],
-                    2.0 * vsigma[2][0, :],
-                    vsigma[1][0, :] + vsigma[2][0, :],
-                ],
-                axis=1,
-            )
-            vxc_3 = np.stack([vtau[0][0, :], vtau[1][0, :]], axis=1)
-            vxc_2 = np.zeros_like(vxc_3)
-
-        fxc = None  # Second derivative not implemented
-        kxc = None  # Second derivative not implemented
-        exc = vxc.detach().cpu().numpy().astype(np.float64)
         return (
             exc,
-            (
-                vxc_0.astype(np.float64),
-                vxc_1.astype(np.float64),
-                vxc_2.astype(np.float64),
-                vxc_3.astype(np.float64),
-            ),
-            fxc,
-            kxc,
+            first.detach().cpu().numpy(),
+            second.detach().cpu().numpy(),
         )
+
+    def eval_xc(
+        self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
+    ):
+        # The grid is streamed in blocks so that the autograd buffers stay
+        # within self.max_memory
+        points = self.screen(rho, spin)
+        with thread_budget(torch_threads=self.num_threads):
+            return eval_xc_in_blocks(
+                self.eval_xc_block, rho, spin, deriv, self.block_size(deriv), points
+            )
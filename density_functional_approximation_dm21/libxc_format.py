@@ -0,0 +1,185 @@
+import numpy as np
+import pyscf
+
+# Rows express libxc variables through the seven features
+# (rho_a, rho_b, norm_grad_a, norm_grad_b, norm_grad, tau_a, tau_b),
+# where norm_grad = sigma_uu + 2 * sigma_ud + sigma_dd.
+# Unpolarized: rho, sigma, tau
+libxc_variables_unpolarized = np.array(
+    [
+        [0.5, 0.5, 0, 0, 0, 0, 0],
+        [0, 0, 0.25, 0.25, 1, 0, 0],
+        [0, 0, 0, 0, 0, 0.5, 0.5],
+    ]
+)
+# Polarized: rho_u, rho_d, sigma_uu, sigma_ud, sigma_dd, tau_u, tau_d
+libxc_variables_polarized = np.array(
+    [
+        [1, 0, 0, 0, 0, 0, 0],
+        [0, 1, 0, 0, 0, 0, 0],
+        [0, 0, 1, 0, 1, 0, 0],
+        [0, 0, 0, 0, 2, 0, 0],
+        [0, 0, 0, 1, 1, 0, 0],
+        [0, 0, 0, 0, 0, 1, 0],
+        [0, 0, 0, 0, 0, 0, 1],
+    ],
+    dtype=np.float64,
+)
+# Pairs of libxc variables in the blocks of fxc, in libxc's order (v2rho2,
+# v2rhosigma, v2sigma2, v2lapl2, v2tau2, v2rholapl, v2rhotau, v2lapltau,
+# v2sigmalapl, v2sigmatau); None marks the laplacian blocks
+fxc_indices_polarized = [
+    [(0, 0), (0, 1), (1, 1)],
+    [(r, s) for r in (0, 1) for s in (2, 3, 4)],
+    [(2, 2), (2, 3), (2, 4), (3, 3), (3, 4), (4, 4)],
+    None,
+    [(5, 5), (5, 6), (6, 6)],
+    None,
+    [(r, t) for r in (0, 1) for t in (5, 6)],
+    None,
+    None,
+    [(s, t) for s in (2, 3, 4) for t in (5, 6)],
+]
+fxc_indices_unpolarized = [
+    [(0, 0)],
+    [(0, 1)],
+    [(1, 1)],
+    None,
+    [(2, 2)],
+    None,
+    [(0, 2)],
+    None,
+    None,
+    [(1, 2)],
+]
+
+# define_xc_ of PySCF < 2.14 takes the entries [0, 1, 2, 6, 4, 9] of a
+# ten-entry fxc but sorts them as (v2rho2, v2rhosigma, v2sigma2, v2rhotau,
+# v2sigmatau, v2tau2), so for it v2sigmatau and v2tau2 trade places
+pyscf_version = tuple(int(part) for part in pyscf.__version__.split(".")[:2])
+swap_fxc_tau_blocks = pyscf_version < (2, 14)
+
+# Points with a total density at or below this are skipped (exc = vxc = 0),
+# like libxc's dens_threshold. 0 evaluates every point.
+DENSITY_THRESHOLD = 1e-12
+# Default budget (MB) for the XC evaluation, same as PySCF's MAX_MEMORY default
+MAX_MEMORY = 4000
+# Second derivatives keep the graph of the first backward pass alive
+memory_factor_fxc = 4
+
+
+def screen_points(rho, spin, density_threshold):
+    """Indices of the grid points whose total density exceeds density_threshold"""
+    rho_total = rho[0] if spin == 0 else rho[0][0] + rho[1][0]
+    return np.flatnonzero(rho_total > density_threshold)
+
+
+class BlockedEvaluation:
+    """
+    Block size and density screening of the eval_xc backends. Subclasses set
+    memory_per_grid_point ({DFT: peak bytes per grid point of one
+    forward/backward pass}), self.model, self.max_memory and
+    self.density_threshold, and zero self.total_points and self.skipped_points
+    """
+
+    memory_per_grid_point = {}
+
+    def block_size(self, deriv=1):
+        """Number of grid points evaluated at once within self.max_memory (MB)"""
+        bytes_per_point = self.memory_per_grid_point[self.model.DFT]
+        if deriv > 1:
+            bytes_per_point *= memory_factor_fxc
+        return max(int(self.max_memory * 1e6 / bytes_per_point), 1)
+
+    def screen(self, rho, spin):
+        """
+        Grid points above self.density_threshold (None when screening is off);
+        counts the skipped points
+        """
+        ngrids = np.shape(rho)[-1]
+        self.total_points += ngrids
+        if not self.density_threshold:
+            return None
+        points = screen_points(rho, spin, self.density_threshold)
+        self.skipped_points += ngrids - len(points)
+        return points
+
+    @property
+    def skipped_fraction(self):
+        """Fraction of the grid points skipped by screening so far"""
+        return self.skipped_points / max(self.total_points, 1)
+
+
+def spin_densities(rho, spin):
+    """
+    (rho_a, rho_b, variables) of a block of PySCF rho: the (5, n) spin
+    densities (rho, grad_x, grad_y, grad_z, tau) and the libxc variable map
+    """
+    if spin == 0:
+        return rho / 2, rho / 2, libxc_variables_unpolarized
+    return rho[0], rho[1], libxc_variables_polarized
+
+
+def eval_xc_in_blocks(eval_xc_block, rho, spin, deriv, blksize, points=None):
+    """
+    PySCF eval_xc on top of eval_xc_block(rho, spin, deriv), which returns
+    exc (n,), the first (k, n) and the second (k, k, n) derivatives with
+    respect to the k libxc variables of one block of points of rho.
+    The grid is streamed in blocks of blksize points and the results go
+    straight into preallocated arrays. With points (see screen_points) only
+    those grid points are evaluated and the rest are left zero.
+    """
+    rho = np.asarray(rho)
+    ngrids = rho.shape[-1]
+    if spin == 0:
+        nvar = len(libxc_variables_unpolarized)
+    else:
+        nvar = len(libxc_variables_polarized)
+    if points is None:
+        npoints = ngrids
+        allocate = np.empty
+    else:
+        npoints = len(points)
+        allocate = np.zeros
+    exc = allocate(ngrids)
+    first = allocate((nvar, ngrids)) if deriv > 0 else None
+    second = allocate((nvar, nvar, ngrids)) if deriv > 1 else None
+
+    for p0 in range(0, npoints, blksize):
+        p1 = min(p0 + blksize, npoints)
+        block = slice(p0, p1) if points is None else points[p0:p1]
+        exc_blk, first_blk, second_blk = eval_xc_block(rho[..., block], spin, deriv)
+        exc[block] = exc_blk
+        if deriv > 0:
+            first[:, block] = first_blk
+        if deriv > 1:
+            second[:, :, block] = second_blk
+
+    # vlapl must stay None: PySCF stacks every non-None entry of vxc into
+    # one array, so a zero laplacian term shifts vtau out. fxc keeps all ten
+    # libxc entries, PySCF picks the non-laplacian ones by position.
+    vxc = fxc = None
+    kxc = None  # Third derivative not implemented
+    if spin == 0:
+        if deriv > 0:
+            vxc = (first[0], first[1], None, first[2])
+        if deriv > 1:
+            fxc = tuple(
+                None if block is None else second[block[0]]
+                for block in fxc_indices_unpolarized
+            )
+    else:
+        if deriv > 0:
+            vxc = (first[0:2].T, first[2:5].T, None, first[5:7].T)
+        if deriv > 1:
+            fxc = tuple(
+                None
+                if block is None
+                else np.stack([second[i, j] for i, j in block], axis=1)
+                for block in fxc_indices_polarized
+            )
+
+    if deriv > 1 and swap_fxc_tau_blocks:
+        fxc = fxc[:4] + fxc[9:] + fxc[5:9] + fxc[4:5]
+
+    return exc, vxc, fxc, kxc
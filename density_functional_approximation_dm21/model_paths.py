@@ -0,0 +1,61 @@
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+# Compiled energy densities and converged density matrices
+cache_dir = os.environ.get(
+    "NN_FUNCTIONAL_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "nn_functional"),
+)
+relative_path_to_model_state_dict = {
+    "NN_PBE": "checkpoints/NN_PBE/state_dict.pth",
+    "NN_XALPHA": "checkpoints/NN_XALPHA/state_dict.pth",
+}
+
+omega_str_list = ["0", "0076", "067", "18", "33", "50", "67", "82", "93", "99"]
+
+relative_path_to_model_state_dict.update(
+    {
+        f"NN_XALPHA_{omega}": f"checkpoints/NN_XALPHA/state_dict_0.{omega}.pth"
+        for omega in omega_str_list
+    }
+)
+relative_path_to_model_state_dict.update(
+    {
+        f"NN_PBE_{omega}": f"checkpoints/NN_PBE/state_dict_0.{omega}.pth"
+        for omega in omega_str_list
+    }
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_XALPHA_100": f"checkpoints/NN_XALPHA/state_dict_1.pth"}
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_PBE_100": f"checkpoints/NN_PBE/state_dict_1.pth"}
+)
+relative_path_to_model_state_dict.update(
+    {f"NN_PBE_star": f"checkpoints/NN_PBE/state_dict_*.pth"}
+)
+
+omega_str_list.append("100")
+
+# Loaded models kept per process by the backends
+MODEL_CACHE_SIZE = 32
+
+
+def available_models(on_disk=False):
+    """
+    Names of the registered checkpoints (NN_PBE_*/NN_XALPHA_* omega family,
+    NN_PBE_star, ...) without loading them; with on_disk=True only those
+    whose weights are present in checkpoints/
+    """
+    return [
+        name
+        for name, path in relative_path_to_model_state_dict.items()
+        if not on_disk or os.path.exists(os.path.join(dir_path, path))
+    ]
+
+
+def omega_family(dft, on_disk=False):
+    """Checkpoint names {dft}_{omega} (dft NN_PBE or NN_XALPHA) in omega order"""
+    available = available_models(on_disk)
+    names = [f"{dft}_{omega}" for omega in omega_str_list]
+    return [name for name in names if name in available]
@@ -0,0 +1,505 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+from scipy.special import erf
+
+from .constants import EPS_RHO, EPS_SIGMA, PBE_CONSTANTS, S_FACTOR, TAU_TF_FACTOR
+from .libxc_format import (
+    DENSITY_THRESHOLD,
+    MAX_MEMORY,
+    BlockedEvaluation,
+    eval_xc_in_blocks,
+    spin_densities,
+)
+from .model_paths import (
+    MODEL_CACHE_SIZE,
+    dir_path,
+    omega_str_list,
+    relative_path_to_model_state_dict,
+)
+from .xc_formulas import (
+    pbe_xc,
+    pbe_xc_and_derivatives,
+    xalpha_xc,
+    xalpha_xc_and_derivatives,
+)
+
+true_constants_PBE = np.array(PBE_CONSTANTS)
+
+# Peak memory (bytes) held per grid point by one forward/reverse pass
+memory_per_grid_point = {
+    "PBE": 16e3,
+    "XALPHA": 6e3,
+}
+
+
+def path_to_numpy_state_dict(name):
+    return os.path.join(
+        dir_path, relative_path_to_model_state_dict[name].replace(".pth", ".npz")
+    )
+
+
+def export_state_dict(name):
+    """
+    Write the weights of a .pth checkpoint next to it as .npz (needs torch)
+    """
+    import torch
+
+    path_to_model_state_dict = os.path.join(
+        dir_path, relative_path_to_model_state_dict[name]
+    )
+    state_dict = torch.load(path_to_model_state_dict, map_location=torch.device("cpu"))
+    np.savez(
+        path_to_numpy_state_dict(name),
+        **{key: value.double().numpy() for key, value in state_dict.items()},
+    )
+
+
+# Layers: each forward returns the output and what its backward needs
+
+
+def linear(x, weight, bias=None):
+    out = x @ weight.T
+    if bias is not None:
+        out += bias
+    return out
+
+
+def row_mean(x):
+    # Matrix-vector product is much faster than reducing rows of h_dim values
+    return (x @ np.full(x.shape[1], 1 / x.shape[1]))[:, None]
+
+
+def layer_norm(x, weight, bias, eps=1e-5):
+    x_hat = x - row_mean(x)
+    inv_std = 1 / np.sqrt(row_mean(x_hat * x_hat) + eps)
+    x_hat *= inv_std
+    out = x_hat * weight
+    out += bias
+    return out, (x_hat, inv_std, weight)
+
+
+def layer_norm_backward(grad, cache):
+    x_hat, inv_std, weight = cache
+    grad = grad * weight
+    projection = x_hat * row_mean(grad * x_hat)
+    grad -= row_mean(grad)
+    grad -= projection
+    grad *= inv_std
+    return grad
+
+
+def gelu(x):
+    cdf = erf(x * np.sqrt(0.5))
+    cdf += 1
+    cdf *= 0.5
+    return x * cdf, (x, cdf)
+
+
+def gelu_backward(grad, cache):
+    x, cdf = cache
+    pdf = x * x
+    pdf *= -0.5
+    np.exp(pdf, out=pdf)
+    pdf *= x
+    pdf *= 1 / np.sqrt(2 * np.pi)
+    pdf += cdf
+    pdf *= grad
+    return pdf
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def shifted_elu(x):
+    """Value and derivative of elu(x) + 1"""
+    exp = np.exp(np.minimum(x, 0))
+    return np.where(x > 0, x + 1, exp), np.where(x > 0, 1.0, exp)
+
+
+class Network:
+    """
+    NumPy counterpart of the Linear-LayerNorm-GELU input layer, the ResBlocks
+    and the output Linear of NN_models (evaluation mode, no dropout)
+    """
+
+    def __init__(self, state_dict, prefix):
+        self.input_layer = (
+            state_dict[f"{prefix}.0.weight"],
+            state_dict[f"{prefix}.1.weight"],
+            state_dict[f"{prefix}.1.bias"],
+        )
+        self.res_blocks = []
+        index = 3
+        while f"{prefix}.{index}.fc.0.weight" in state_dict:
+            block = f"{prefix}.{index}.fc"
+            self.res_blocks.append(
+                (
+                    state_dict[f"{block}.0.weight"],
+                    state_dict[f"{block}.1.weight"],
+                    state_dict[f"{block}.1.bias"],
+                    state_dict[f"{block}.3.weight"],
+                    state_dict[f"{block}.4.weight"],
+                    state_dict[f"{block}.4.bias"],
+                )
+            )
+            index += 1
+        if f"{prefix}.{index}.weight" not in state_dict:
+            raise KeyError(f"Unsupported architecture for {prefix}")
+        self.output_layer = (
+            state_dict[f"{prefix}.{index}.weight"],
+            state_dict[f"{prefix}.{index}.bias"],
+        )
+
+    def forward(self, x):
+        caches = []
+        weight, norm_weight, norm_bias = self.input_layer
+        x, norm_cache = layer_norm(linear(x, weight), norm_weight, norm_bias)
+        x, gelu_cache = gelu(x)
+        caches.append((norm_cache, gelu_cache))
+
+        for weight_1, norm_1, bias_1, weight_2, norm_2, bias_2 in self.res_blocks:
+            h, norm_cache_1 = layer_norm(linear(x, weight_1), norm_1, bias_1)
+            h, gelu_cache_1 = gelu(h)
+            h, norm_cache_2 = layer_norm(linear(h, weight_2), norm_2, bias_2)
+            x, gelu_cache_2 = gelu(h + x)
+            caches.append((norm_cache_1, gelu_cache_1, norm_cache_2, gelu_cache_2))
+
+        return linear(x, *self.output_layer), caches
+
+    def backward(self, grad, caches):
+        grad = grad @ self.output_layer[0]
+
+        for block, cache in zip(self.res_blocks[::-1], caches[:0:-1]):
+            weight_1, _, _, weight_2, _, _ = block
+            norm_cache_1, gelu_cache_1, norm_cache_2, gelu_cache_2 = cache
+            grad = gelu_backward(grad, gelu_cache_2)
+            h = layer_norm_backward(grad, norm_cache_2) @ weight_2
+            h = gelu_backward(h, gelu_cache_1)
+            grad = grad + layer_norm_backward(h, norm_cache_1) @ weight_1
+
+        norm_cache, gelu_cache = caches[0]
+        grad = gelu_backward(grad, gelu_cache)
+        return layer_norm_backward(grad, norm_cache) @ self.input_layer[0]
+
+
+class MLOptimizer:
+    """NumPy counterpart of NN_models.MLOptimizer"""
+
+    DFT = "XALPHA"
+    permutation = [1, 0, 4, 3, 2, 6, 5]
+
+    def __init__(self, state_dict):
+        self.network = Network(state_dict, "hidden_layers")
+
+    def forward(self, x):
+        """
+        Returns the (n, 1) constants and the function mapping their
+        gradient onto the gradient with respect to x
+        """
+        npoints = x.shape[0]
+        # Both spin orderings go through the network as one batch
+        out, caches = self.network.forward(np.vstack([x, x[:, self.permutation]]))
+        sigma = sigmoid(0.5 * out)
+        constants = 1.05 * (sigma[:npoints] + sigma[npoints:])
+
+        def backward(grad):
+            grad = np.vstack([grad, grad]) * 0.525 * sigma * (1 - sigma)
+            grad = self.network.backward(grad, caches)
+            grad_x = grad[:npoints].copy()
+            grad_x[:, self.permutation] += grad[npoints:]
+            return grad_x
+
+        return constants, backward
+
+
+class pcPBEMLOptimizer:
+    """NumPy counterpart of NN_models.pcPBEMLOptimizer"""
+
+    DFT = "PBE"
+    constrained = True
+
+    def __init__(self, state_dict):
+        self.network_x = Network(state_dict, "hidden_layers_x")
+        self.network_c = Network(state_dict, "hidden_layers_c")
+
+    def forward(self, x):
+        """
+        Returns the (n, 6) constants (beta, gamma, kappa_up, mu_up,
+        kappa_down, mu_down) and the function mapping their gradient
+        onto the gradient with respect to x
+        """
+        npoints = x.shape[0]
+
+        # Exchange: spin up, spin down and (when constrained) the zero
+        # gradient limit, which is the same input for every point
+        inputs_x = [x[:, [2, 5]], x[:, [4, 6]]]
+        # Correlation: x and (when constrained) its beta and gamma limits
+        inputs_c = [x]
+        if self.constrained:
+            inputs_x.append(np.zeros((1, 2)))
+            sigma_zero_beta = x.copy()
+            sigma_zero_beta[:, 2:5] = 0
+            rho_inf = x.copy()
+            rho_inf[:, :2] = 1
+            inputs_c.extend([sigma_zero_beta, rho_inf])
+
+        out_x, caches_x = self.network_x.forward(np.vstack(inputs_x))
+        out_c, caches_c = self.network_c.forward(np.vstack(inputs_c))
+        up, down = out_x[:npoints], out_x[npoints : 2 * npoints]
+        beta, gamma = out_c[:npoints, 0], out_c[:npoints, 1]
+        mu_up, mu_down = up[:, 1], down[:, 1]
+        if self.constrained:
+            beta = beta - out_c[npoints : 2 * npoints, 0]
+            gamma = gamma - out_c[2 * npoints :, 1]
+            mu_up = mu_up - out_x[-1, 1]
+            mu_down = mu_down - out_x[-1, 1]
+
+        beta = sigmoid(8 * beta)
+        gamma, dgamma = shifted_elu(gamma)
+        mu_up, dmu_up = shifted_elu(mu_up)
+        mu_down, dmu_down = shifted_elu(mu_down)
+        kappa_up = sigmoid(4 * (up[:, 0] + 0.5))
+        kappa_down = sigmoid(4 * (down[:, 0] + 0.5))
+
+        constants = np.stack(
+            [
+                (beta + 1.5) / 2,
+                gamma,
+                kappa_up,
+                mu_up,
+                kappa_down,
+                mu_down,
+            ],
+            axis=1,
+        ) * true_constants_PBE[[0, 1, 22, 23, 24, 25]]
+
+        def backward(grad):
+            grad = grad * true_constants_PBE[[0, 1, 22, 23, 24, 25]]
+            grad_beta = grad[:, 0] * 4 * beta * (1 - beta)
+            grad_gamma = grad[:, 1] * dgamma
+
+            # Rows past 2 * npoints (the zero gradient limit) do not depend on x
+            grad_x = np.zeros((len(out_x), 2))
+            grad_x[:npoints, 0] = grad[:, 2] * 4 * kappa_up * (1 - kappa_up)
+            grad_x[:npoints, 1] = grad[:, 3] * dmu_up
+            grad_x[npoints : 2 * npoints, 0] = (
+                grad[:, 4] * 4 * kappa_down * (1 - kappa_down)
+            )
+            grad_x[npoints : 2 * npoints, 1] = grad[:, 5] * dmu_down
+            grad_c = np.zeros((len(out_c), 2))
+            grad_c[:npoints, 0] = grad_beta
+            grad_c[:npoints, 1] = grad_gamma
+            if self.constrained:
+                grad_c[npoints : 2 * npoints, 0] = -grad_beta
+                grad_c[2 * npoints :, 1] = -grad_gamma
+
+            grad_x = self.network_x.backward(grad_x, caches_x)
+            grad_c = self.network_c.backward(grad_c, caches_c)
+
+            grad_inputs = grad_c[:npoints].copy()
+            grad_inputs[:, [2, 5]] += grad_x[:npoints]
+            grad_inputs[:, [4, 6]] += grad_x[npoints : 2 * npoints]
+            if self.constrained:
+                grad_inputs[:, [0, 1, 5, 6]] += grad_c[npoints : 2 * npoints][
+                    :, [0, 1, 5, 6]
+                ]
+                grad_inputs[:, 2:] += grad_c[2 * npoints :, 2:]
+            return grad_inputs
+
+        return constants, backward
+
+
+class pcPBEstar(pcPBEMLOptimizer):
+    """NumPy counterpart of NN_models.pcPBEstar"""
+
+    constrained = False
+
+
+numpy_model = {
+    "NN_PBE": pcPBEMLOptimizer,
+    "NN_XALPHA": MLOptimizer,
+    "NN_PBE_star": pcPBEstar,
+}
+numpy_model.update({f"NN_XALPHA_{omega}": MLOptimizer for omega in omega_str_list})
+numpy_model.update({f"NN_PBE_{omega}": pcPBEMLOptimizer for omega in omega_str_list})
+
+
+def nn_inputs_and_backward(features):
+    """
+    The same transform of (rho_a, rho_b, norm_grad_a, norm_grad_b, norm_grad,
+    tau_a, tau_b) into the (n, 7) NN inputs as functional.nn_inputs,
+    with the function mapping the input gradient onto the features
+    """
+    rho_a, rho_b, grad_a, grad_b, grad, tau_a, tau_b = features
+    rho_a_inp = rho_a + EPS_RHO
+    rho_b_inp = rho_b + EPS_RHO
+    rho_inp = rho_a_inp + rho_b_inp - EPS_RHO
+    cbrt_a = np.cbrt(rho_a_inp)
+    cbrt_b = np.cbrt(rho_b_inp)
+    rho_a_43 = rho_a_inp * cbrt_a
+    rho_b_43 = rho_b_inp * cbrt_b
+
+    s_a = np.sqrt(grad_a + EPS_SIGMA) * S_FACTOR / rho_a_43
+    s = np.sqrt(grad + EPS_SIGMA) * S_FACTOR / rho_inp ** (4 / 3)
+    s_b = np.sqrt(grad_b + EPS_SIGMA) * S_FACTOR / rho_b_43
+    tau_tf_alpha = TAU_TF_FACTOR * rho_a_43 * cbrt_a
+    tau_tf_beta = TAU_TF_FACTOR * rho_b_43 * cbrt_b
+    tau_w_alpha = grad_a / (8 * rho_a_inp)
+    tau_w_beta = grad_b / (8 * rho_b_inp)
+    alpha_a = (tau_a - tau_w_alpha) / tau_tf_alpha
+    alpha_b = (tau_b - tau_w_beta) / tau_tf_beta
+
+    inputs = np.tanh(
+        np.stack(
+            [
+                cbrt_a,
+                cbrt_b,
+                s_a,
+                s,
+                s_b,
+                alpha_a - 1,
+                alpha_b - 1,
+            ],
+            axis=1,
+        )
+    )
+
+    def backward(grad_inputs):
+        g = (grad_inputs * (1 - inputs**2)).T
+        grad_features = np.empty_like(features)
+        grad_features[0] = (
+            g[0] * cbrt_a / (3 * rho_a_inp)
+            - 4 / 3 * (g[2] * s_a / rho_a_inp + g[3] * s / rho_inp)
+            + g[5] * (tau_w_alpha / tau_tf_alpha - 5 / 3 * alpha_a) / rho_a_inp
+        )
+        grad_features[1] = (
+            g[1] * cbrt_b / (3 * rho_b_inp)
+            - 4 / 3 * (g[4] * s_b / rho_b_inp + g[3] * s / rho_inp)
+            + g[6] * (tau_w_beta / tau_tf_beta - 5 / 3 * alpha_b) / rho_b_inp
+        )
+        grad_features[2] = (
+            g[2] * s_a / (2 * (grad_a + EPS_SIGMA))
+            - g[5] / (8 * rho_a_inp * tau_tf_alpha)
+        )
+        grad_features[3] = (
+            g[4] * s_b / (2 * (grad_b + EPS_SIGMA))
+            - g[6] / (8 * rho_b_inp * tau_tf_beta)
+        )
+        grad_features[4] = g[3] * s / (2 * (grad + EPS_SIGMA))
+        grad_features[5] = g[5] / tau_tf_alpha
+        grad_features[6] = g[6] / tau_tf_beta
+        return grad_features
+
+    return inputs, backward
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_model(name):
+    """
+    Model with the exported weights of checkpoint name, loaded once per process
+    """
+    with np.load(path_to_numpy_state_dict(name)) as state_dict:
+        return numpy_model[name](dict(state_dict))
+
+
+class NN_FUNCTIONAL_NUMPY(BlockedEvaluation):
+    """
+    Torch-free NN_FUNCTIONAL: evaluates the checkpoints exported to .npz by
+    export_state_dict and returns the same eval_xc output (up to first
+    derivatives)
+    """
+
+    memory_per_grid_point = memory_per_grid_point
+
+    def __init__(
+        self, name, max_memory=MAX_MEMORY, density_threshold=DENSITY_THRESHOLD
+    ):
+        self.model = load_model(name)
+        self.name = name
+        self.max_memory = max_memory
+        self.density_threshold = density_threshold
+        self.total_points = 0
+        self.skipped_points = 0
+
+    def energy_and_gradient(self, features, deriv=1):
+        """
+        XC energy per particle from the (7, n) features (see
+        functional.XCEnergyDensity) and, for deriv > 0, the gradient of the
+        unweighted XC energy with respect to the features. deriv == 0 skips
+        every reverse pass and returns None as the gradient.
+        """
+        rho_a, rho_b, grad_a, grad_b, grad, _, _ = features
+        inputs, inputs_backward = nn_inputs_and_backward(features)
+        constants, model_backward = self.model.forward(inputs)
+
+        if self.model.DFT == "PBE":
+            sigma_ab = (grad - grad_a - grad_b) / 2
+            args = (rho_a, rho_b, grad_a, sigma_ab, grad_b, *constants.T)
+            if deriv == 0:
+                return pbe_xc(np, *args), None
+            energy, derivatives = pbe_xc_and_derivatives(np, *args)
+        else:
+            args = (rho_a + rho_b, constants[:, 0])
+            if deriv == 0:
+                return xalpha_xc(np, *args), None
+            energy, (d_rho, d_alpha) = xalpha_xc_and_derivatives(np, *args)
+            derivatives = (d_rho, d_rho, d_alpha)
+
+        density = rho_a + rho_b
+        grad_constants = density[:, None] * np.stack(
+            derivatives[len(derivatives) - constants.shape[1] :], axis=1
+        )
+        gradient = inputs_backward(model_backward(grad_constants))
+        gradient[0] += energy + density * derivatives[0]
+        gradient[1] += energy + density * derivatives[1]
+        if self.model.DFT == "PBE":
+            # sigma_ab = (norm_grad - norm_grad_a - norm_grad_b) / 2
+            d_sigma_aa, d_sigma_ab, d_sigma_bb = derivatives[2:5]
+            gradient[2] += density * (d_sigma_aa - d_sigma_ab / 2)
+            gradient[3] += density * (d_sigma_bb - d_sigma_ab / 2)
+            gradient[4] += density * d_sigma_ab / 2
+        return energy, gradient
+
+    def eval_xc_block(self, rho, spin, deriv=1):
+        """See functional.NN_FUNCTIONAL.eval_xc_block"""
+        if deriv > 1:
+            raise ValueError(
+                "The NumPy backend provides first derivatives only, "
+                "use the torch backend (NN_FUNCTIONAL) for deriv > 1"
+            )
+
+        rho_a, rho_b, variables = spin_densities(rho, spin)
+
+        grad = rho_a[1:4] + rho_b[1:4]
+        features = np.stack(
+            [
+                rho_a[0],
+                rho_b[0],
+                np.sum(rho_a[1:4] ** 2, axis=0),
+                np.sum(rho_b[1:4] ** 2, axis=0),
+                np.sum(grad**2, axis=0),
+                rho_a[4],
+                rho_b[4],
+            ]
+        )
+        energy, gradient = self.energy_and_gradient(features, deriv)
+        if deriv == 0:
+            return energy, None, None
+        return energy, variables @ gradient, None
+
+    def eval_xc(
+        self, xc_code, rho, spin, relativity=0, deriv=1, omega=None, verbose=None
+    ):
+        points = self.screen(rho, spin)
+        return eval_xc_in_blocks(
+            self.eval_xc_block, rho, spin, deriv, self.block_size(deriv), points
+        )
+
+
+if __name__ == "__main__":
+    for name in relative_path_to_model_state_dict:
+        if os.path.exists(os.path.join(dir_path, relative_path_to_model_state_dict[name])):
+            export_state_dict(name)
@@ -0,0 +1,101 @@
+from optparse import OptionParser
+
+import numpy as np
+from pyscf import dft, gto
+
+from .functional import NN_FUNCTIONAL
+
+# Small closed- and open-shell molecules (Angstrom), charge, spin
+reference_molecules = {
+    "H2O": ("O 0 0 0.1173; H 0 0.7572 -0.4692; H 0 -0.7572 -0.4692", 0, 0),
+    "NH3": (
+        "N 0 0 0.1162; H 0 0.9375 -0.2711; "
+        "H 0.8119 -0.4688 -0.2711; H -0.8119 -0.4688 -0.2711",
+        0,
+        0,
+    ),
+    "N2": ("N 0 0 0.5488; N 0 0 -0.5488", 0, 0),
+    "HF": ("F 0 0 0.0917; H 0 0 -0.8254", 0, 0),
+    "Ne": ("Ne 0 0 0", 0, 0),
+    "OH": ("O 0 0 0.1083; H 0 0 -0.8665", 0, 1),
+    "CH3": (
+        "C 0 0 0; H 0 1.0790 0; H 0.9344 -0.5395 0; H -0.9344 -0.5395 0",
+        0,
+        1,
+    ),
+}
+
+
+def reference_densities(basis="def2-svp", grid_level=3):
+    """
+    PBE densities (rho in eval_xc layout, spin, weights) of reference_molecules
+    """
+    densities = {}
+    for name, (atom, charge, spin) in reference_molecules.items():
+        mol = gto.M(atom=atom, basis=basis, charge=charge, spin=spin, verbose=0)
+        mf = dft.RKS(mol) if spin == 0 else dft.UKS(mol)
+        mf.xc = "PBE"
+        mf.grids.level = grid_level
+        mf.kernel()
+
+        ao = dft.numint.eval_ao(mol, mf.grids.coords, deriv=1)
+        dm = mf.make_rdm1()
+        if spin == 0:
+            rho = dft.numint.eval_rho(mol, ao, dm, xctype="MGGA", with_lapl=False)
+        else:
+            rho = np.stack(
+                [
+                    dft.numint.eval_rho(mol, ao, dm_s, xctype="MGGA", with_lapl=False)
+                    for dm_s in dm
+                ]
+            )
+        densities[name] = (rho, int(spin > 0), mf.grids.weights)
+    return densities
+
+
+def xc_energy(functional, rho, spin, weights):
+    exc = functional.eval_xc("", rho, spin, deriv=0)[0]
+    rho_total = rho[0] if spin == 0 else rho[0, 0] + rho[1, 0]
+    return np.dot(weights, rho_total * exc)
+
+
+def energy_deviation(name, precision="float32", densities=None):
+    """
+    Difference (Hartree) of the XC energy evaluated with the network in
+    precision and in float64 on the reference PBE densities. At a fixed
+    density every other energy term is unchanged, so this is the deviation
+    of the total energy (to first order also of the SCF energy).
+    """
+    if densities is None:
+        densities = reference_densities()
+    reference = NN_FUNCTIONAL(name)
+    functional = NN_FUNCTIONAL(name, precision=precision)
+
+    deviations = {}
+    for molecule, (rho, spin, weights) in densities.items():
+        deviations[molecule] = xc_energy(
+            functional, rho, spin, weights
+        ) - xc_energy(reference, rho, spin, weights)
+        print(f"{name} {precision} {molecule}: {deviations[molecule]:.2e} Ha")
+    print(
+        f"{name} {precision} max |dE|: "
+        f"{max(abs(value) for value in deviations.values()):.2e} Ha"
+    )
+    return deviations
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option(
+        "--Functionals",
+        type=str,
+        default="NN_PBE_18,NN_PBE_star,NN_XALPHA_99",
+        help="Comma separated checkpoint names",
+    )
+    parser.add_option("--Precision", type=str, default="float32")
+
+    (Opts, args) = parser.parse_args()
+
+    densities = reference_densities()
+    for name in Opts.Functionals.split(","):
+        energy_deviation(name, Opts.Precision, densities)
@@ -0,0 +1,174 @@
+import numpy as np
+from pyscf import scf
+
+# Strategies in the order they are tried. diis and adiis are watched cycle by
+# cycle and abandoned as soon as the energy diverges, oscillates or stalls;
+# soscf and smearing run their full budget.
+STAGES = ("diis", "adiis", "soscf", "smearing")
+NEWTON_STAGES = ("soscf", "smearing")
+# Without second derivatives of the XC energy (NumPy backend)
+FIRST_ORDER_STAGES = ("diis", "adiis")
+MONITORED = ("diis", "adiis")
+
+SMEARING_SIGMA = 0.005  # Hartree
+
+
+class StrategySwitch(Exception):
+    pass
+
+
+class ConvergenceMonitor:
+    """
+    SCF callback recording the per-cycle energies. With switching, raises
+    StrategySwitch when the energy rises more than divergence_tol above the
+    lowest one seen, alternates in sign without shrinking over window cycles,
+    or has not dropped by an order of magnitude in its change over
+    2 * window cycles.
+    """
+
+    def __init__(self, conv_tol, switching=True, window=6, divergence_tol=1e-2):
+        self.conv_tol = conv_tol
+        self.switching = switching
+        self.window = window
+        self.divergence_tol = divergence_tol
+        self.energies = []
+        self.best_dm = None
+
+    def __call__(self, envs):
+        energy = envs["e_tot"]
+        if not self.energies or energy < min(self.energies):
+            self.best_dm = envs["dm"]
+        self.energies.append(energy)
+        if envs["scf_conv"] or not self.switching:
+            return
+        reason = self.diagnose()
+        if reason:
+            raise StrategySwitch(reason)
+
+    def diagnose(self):
+        energies = np.array(self.energies)
+        if len(energies) < self.window:
+            return None
+        if energies[-1] - energies.min() > self.divergence_tol:
+            return "diverging"
+
+        changes = np.diff(energies)
+        if len(changes) < self.window:
+            return None
+        recent = changes[-self.window :]
+        if np.abs(recent).min() < 10 * self.conv_tol:
+            return None
+
+        half = self.window // 2
+        sign_flips = np.count_nonzero(np.diff(np.sign(recent)))
+        if sign_flips >= self.window - 2 and (
+            np.abs(recent[half:]).max() > 0.5 * np.abs(recent[:half]).max()
+        ):
+            return "oscillating"
+
+        if len(changes) >= 2 * self.window:
+            earlier = changes[-2 * self.window : -self.window]
+            if np.abs(recent).max() > 0.1 * np.abs(earlier).max():
+                return "stalled"
+        return None
+
+
+def diis_strategy(mf):
+    return mf.copy()
+
+
+def adiis_strategy(mf):
+    """ADIIS extrapolation, damping of the first cycles and level shifting"""
+    mf = mf.copy()
+    mf.DIIS = scf.ADIIS
+    mf.diis_start_cycle = 4
+    mf.damp = 0.5
+    mf.level_shift = 0.25
+    return mf
+
+
+def soscf_strategy(mf):
+    return mf.newton()
+
+
+def smearing_strategy(mf):
+    """Fermi smearing; only a source of a better initial guess for SOSCF"""
+    return scf.addons.smearing(mf.copy(), sigma=SMEARING_SIGMA, method="fermi")
+
+
+def unshifted_gradient_converged(mf):
+    """
+    Whether the orbitals of mf, converged with a level shift, meet the
+    gradient criterion with the unshifted Fock matrix. PySCF's conv_check
+    rediagonalizes the unshifted Fock matrix instead, which swaps
+    near-degenerate frontier orbitals and leaves the converged state.
+    """
+    dm = mf.make_rdm1(mf.mo_coeff, mf.mo_occ)
+    gradient = mf.get_grad(mf.mo_coeff, mf.mo_occ, mf.get_fock(dm=dm))
+    conv_tol_grad = mf.conv_tol_grad or np.sqrt(mf.conv_tol)
+    return np.linalg.norm(gradient) < conv_tol_grad
+
+
+strategies = {
+    "diis": diis_strategy,
+    "adiis": adiis_strategy,
+    "soscf": soscf_strategy,
+    "smearing": smearing_strategy,
+}
+
+
+def converge(mf, dm0=None, stages=STAGES):
+    """
+    Runs the SCF of mf from dm0 with the strategies of stages in turn, each
+    starting from the best density of the previous one, until one converges.
+    A stage that fails with an error is logged and skipped. The energy,
+    orbitals and convergence flag of the last stage that ran to the end are
+    copied to mf, and mf.cycles counts the cycles of all stages. Returns the
+    total energy; raises the last error when no stage ran to the end.
+    """
+    cycles = 0
+    result_mf = error = None
+    for name in stages:
+        switching = name in MONITORED and name != stages[-1]
+        monitor = ConvergenceMonitor(mf.conv_tol, switching)
+        try:
+            stage_mf = strategies[name](mf)
+            stage_mf.callback = monitor
+            if stage_mf.level_shift:
+                stage_mf.conv_check = False
+            stage_mf.kernel(dm0=dm0)
+            if name == "smearing":
+                # Integer occupations from the smeared density
+                cycles += len(monitor.energies)
+                smeared_dm = stage_mf.make_rdm1()
+                stage_mf = soscf_strategy(mf)
+                monitor = stage_mf.callback = ConvergenceMonitor(mf.conv_tol, False)
+                stage_mf.kernel(dm0=smeared_dm)
+        except StrategySwitch as E:
+            print(f"SCF {name}: {E} after {len(monitor.energies)} cycles")
+            cycles += len(monitor.energies)
+            dm0 = monitor.best_dm
+            continue
+        except Exception as E:
+            print(f"SCF {name}: failed after {len(monitor.energies)} cycles: {E!r}")
+            cycles += len(monitor.energies)
+            dm0 = monitor.best_dm if monitor.best_dm is not None else dm0
+            error = E
+            continue
+        cycles += len(monitor.energies)
+        if stage_mf.level_shift and stage_mf.converged:
+            stage_mf.converged = unshifted_gradient_converged(stage_mf)
+
+        result_mf = stage_mf
+        if stage_mf.converged:
+            print(f"SCF converged with {name}")
+            break
+        print(f"SCF {name}: not converged after {len(monitor.energies)} cycles")
+        dm0 = monitor.best_dm
+
+    mf.cycles = cycles
+    if result_mf is None:
+        raise error
+    for attribute in ("converged", "e_tot", "mo_energy", "mo_coeff", "mo_occ"):
+        setattr(mf, attribute, getattr(result_mf, attribute))
+    return mf.e_tot
@@ -0,0 +1,81 @@
+import os
+import sys
+from contextlib import contextmanager
+
+from pyscf import lib
+
+
+def allotted_cpus():
+    """
+    CPUs granted to this job: SLURM_CPUS_PER_TASK inside a Slurm allocation,
+    otherwise the CPUs this process may run on
+    """
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        return int(os.environ["SLURM_CPUS_PER_TASK"]), "SLURM_CPUS_PER_TASK"
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)), "affinity mask"
+    return os.cpu_count(), "cpu count"
+
+
+def torch_num_threads(num_threads=None):
+    """
+    Set (if given) and return torch's intra-op threads; None unless torch is
+    already imported, so that torch-free runs never load it
+    """
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    return torch.get_num_threads()
+
+
+def configure_threads(jk_threads=None, xc_threads=None, backend="torch"):
+    """
+    Thread budgets of the two SCF phases from the allotted CPUs: PySCF's
+    OpenMP pool (J/K build, AO evaluation) gets jk_threads and torch's
+    intra-op pool (NN evaluation in eval_xc) gets xc_threads. The phases
+    do not overlap, so by default both use every allotted CPU. torch is only
+    imported for backend "torch"; the NumPy backend (or backend None, no NN
+    functional) runs on PySCF's pool and leaves torch unloaded.
+    """
+    num_cpus, source = allotted_cpus()
+    jk_threads = jk_threads or num_cpus
+    xc_threads = xc_threads or num_cpus
+
+    lib.num_threads(jk_threads)
+    if backend == "torch":
+        import torch  # noqa: F401, the NN evaluation imports it anyway
+    torch_threads = torch_num_threads(xc_threads)
+
+    print(
+        f"Threads: {num_cpus} allotted ({source}), "
+        f"PySCF {lib.num_threads()}, torch {torch_threads}, "
+        f"OMP_NUM_THREADS={os.environ.get('OMP_NUM_THREADS')}"
+    )
+    return jk_threads, xc_threads
+
+
+@contextmanager
+def thread_budget(pyscf_threads=None, torch_threads=None):
+    """
+    Temporarily switch the PySCF and/or torch thread counts; a count left
+    None is neither read nor reset
+    """
+    if pyscf_threads is None and torch_threads is None:
+        yield
+        return
+    previous_pyscf = previous_torch = None
+    if pyscf_threads is not None:
+        previous_pyscf = lib.num_threads()
+        lib.num_threads(pyscf_threads)
+    if torch_threads is not None:
+        previous_torch = torch_num_threads()
+        torch_num_threads(torch_threads)
+    try:
+        yield
+    finally:
+        if previous_pyscf is not None:
+            lib.num_threads(previous_pyscf)
+        if previous_torch is not None:
+            torch_num_threads(previous_torch)
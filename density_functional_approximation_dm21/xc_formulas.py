@@ -0,0 +1,339 @@
+import numpy as np
+
+from .constants import PBE_CONSTANTS
+
+# Closed-form PBE and XAlpha energies per particle and their first
+# derivatives, written once for both backends: xp is the array namespace,
+# torch (PBE.py, SVWN3.py) or numpy (numpy_backend.py). Only sqrt, log1p,
+# expm1 and where are taken from it. Only beta, gamma and the (kappa, mu)
+# pairs vary per point; the PW92 and LDA constants enter as scalars.
+
+FZ20 = PBE_CONSTANTS[2]
+# PBE uses the float32 LDA exchange factor of PBE_CONSTANTS, XAlpha the exact one
+PBE_LDA_X_FACTOR = PBE_CONSTANTS[21]
+LDA_X_FACTOR = -3 / 8 * (3 / np.pi) ** (1 / 3) * 4 ** (2 / 3)
+RS_FACTOR = (3 / (4 * np.pi)) ** (1 / 3)
+X2S = 1 / (2 * (6 * np.pi**2) ** (1 / 3))
+# (a, alpha1, beta1, beta2, beta3, beta4) of g(k) for k = 0, 1, 2
+PW_PARAMS = [
+    (PBE_CONSTANTS[15 + k], PBE_CONSTANTS[18 + k], *PBE_CONSTANTS[3 + k : 15 + k : 3])
+    for k in range(3)
+]
+
+# Regularization of F_PBE and F_XALPHA at vanishing density and gradient
+EPS_ADD = 1e-7
+EPS_ADD_RHO = 1e-10
+EPS_ADD_SIGMA = EPS_ADD_RHO ** (8 / 3)
+EPS = 1e-29
+# Offset of log1p(f2) for f2 <= -1
+EPS_LOG = 10e-8
+# exp(w) of the PBE A overflows above this
+MAX_EXPONENT = 87
+
+
+def pw_g(xp, k, rs, sqrt_rs):
+    a, alpha1, beta1, beta2, beta3, beta4 = PW_PARAMS[k]
+    g_aux = beta1 * sqrt_rs + beta2 * rs + beta3 * rs * sqrt_rs + beta4 * rs**2
+    return -2 * a * (1 + alpha1 * rs) * xp.log1p(1 / (2 * a * g_aux))
+
+
+def pbe_enhancement(x, kappa, mu):
+    return 1 + kappa * (1 - kappa / (kappa + mu * (X2S * x) ** 2))
+
+
+def pbe_correlation_H(xp, f_pw, phi, t, beta, gamma):
+    gamma_phi3 = gamma * phi**3
+    w = -f_pw / gamma_phi3
+    A = beta / (gamma * xp.expm1(xp.where(w < MAX_EXPONENT, w, MAX_EXPONENT)))
+    t2 = t**2
+    f1 = t2 + A * t2**2
+    f2 = beta * f1 / (gamma * (A * f1 + 1))
+    return gamma_phi3 * xp.log1p(xp.where(f2 <= -1, f2 + EPS_LOG, f2))
+
+
+def pbe_xc(
+    xp,
+    rho_a,
+    rho_b,
+    sigma_aa,
+    sigma_ab,
+    sigma_bb,
+    beta,
+    gamma,
+    kappa_a,
+    mu_a,
+    kappa_b,
+    mu_b,
+):
+    """F_PBE energy per particle"""
+    density = rho_a + rho_b + EPS_ADD
+    rs = (3 / (density * (4 * np.pi))) ** (1 / 3)
+    sqrt_rs = xp.sqrt(rs)
+    z = (rho_a - rho_b) / density
+
+    xs0 = xp.sqrt(sigma_aa + EPS_ADD_SIGMA) / (rho_a + EPS_ADD_RHO) ** (4 / 3)
+    # Last sigma and last rho equal 0
+    xs1 = xp.where(
+        (sigma_bb < EPS) & (rho_b < EPS),
+        xs0,
+        xp.sqrt(sigma_bb + EPS_ADD_SIGMA) / (rho_b + EPS_ADD_RHO) ** (4 / 3),
+    )
+    xt = xp.sqrt(sigma_aa + 2 * sigma_ab + sigma_bb + EPS_ADD_SIGMA) / (
+        rho_a + rho_b + EPS_ADD_RHO
+    ) ** (4 / 3)
+
+    # Exchange
+    zp, zm = (1 + z) ** (1 / 3), (1 - z) ** (1 / 3)
+    lda_prefactor = PBE_LDA_X_FACTOR * 2 ** (-4 / 3) * RS_FACTOR / rs
+    exchange = lda_prefactor * (
+        zp**4 * pbe_enhancement(xs0, kappa_a, mu_a)
+        + zm**4 * pbe_enhancement(xs1, kappa_b, mu_b)
+    )
+
+    # PW92
+    g0, g1, g2 = (pw_g(xp, k, rs, sqrt_rs) for k in range(3))
+    f_zeta = (zp**4 + zm**4 - 2) / (2 ** (4 / 3) - 2)
+    g2_fz20 = g2 / FZ20
+    f_pw = g0 + z**4 * f_zeta * (g1 - g0 + g2_fz20) - f_zeta * g2_fz20
+
+    # PBE H
+    phi = (zp**2 + zm**2) / 2
+    t = xt / (4 * 2 ** (1 / 3) * phi * sqrt_rs)
+    return exchange + f_pw + pbe_correlation_H(xp, f_pw, phi, t, beta, gamma)
+
+
+def pbe_xc_unpolarized(xp, rho, sigma, beta, gamma, kappa, mu):
+    """
+    F_PBE of a closed shell from the total rho and sigma: f_zeta(0) = 0 and
+    phi(0) = 1, so f_pw reduces to g(0) and both spins share one
+    enhancement factor
+    """
+    rs = (3 / ((rho + EPS_ADD) * (4 * np.pi))) ** (1 / 3)
+    sqrt_rs = xp.sqrt(rs)
+    xs = xp.sqrt(sigma / 4 + EPS_ADD_SIGMA) / (rho / 2 + EPS_ADD_RHO) ** (4 / 3)
+    xt = xp.sqrt(sigma + EPS_ADD_SIGMA) / (rho + EPS_ADD_RHO) ** (4 / 3)
+
+    lda = 2 * PBE_LDA_X_FACTOR * 2 ** (-4 / 3) * RS_FACTOR / rs
+    exchange = lda * pbe_enhancement(xs, kappa, mu)
+    f_pw = pw_g(xp, 0, rs, sqrt_rs)
+    t = xt / (4 * 2 ** (1 / 3) * sqrt_rs)
+    return exchange + f_pw + pbe_correlation_H(xp, f_pw, 1, t, beta, gamma)
+
+
+def xalpha_xc(xp, rho, alpha):
+    """F_XALPHA energy per particle of the total rho"""
+    return alpha * LDA_X_FACTOR * (rho + EPS) ** (1 / 3)
+
+
+# The same energies together with their analytic first derivatives in one
+# elementwise pass
+
+
+def pw_g_and_derivative(xp, k, rs, sqrt_rs):
+    """PW92 g(k, rs) and its rs derivative"""
+    a, alpha1, beta1, beta2, beta3, beta4 = PW_PARAMS[k]
+    g_aux = beta1 * sqrt_rs + beta2 * rs + beta3 * rs * sqrt_rs + beta4 * rs**2
+    dg_aux = beta1 / (2 * sqrt_rs) + beta2 + 1.5 * beta3 * sqrt_rs + 2 * beta4 * rs
+    q = 1 / (2 * a * g_aux)
+    log = xp.log1p(q)
+    g = -2 * a * (1 + alpha1 * rs) * log
+    dg = -2 * a * alpha1 * log + 2 * a * (1 + alpha1 * rs) * q * dg_aux / (
+        g_aux * (1 + q)
+    )
+    return g, dg
+
+
+def pbe_enhancement_and_derivatives(x, kappa, mu):
+    """PBE exchange enhancement factor and its derivatives over (x, kappa, mu)"""
+    s2 = (X2S * x) ** 2
+    ratio = kappa / (kappa + mu * s2)
+    return (
+        1 + kappa * (1 - ratio),
+        2 * ratio**2 * mu * X2S**2 * x,
+        (1 - ratio) ** 2,
+        ratio**2 * s2,
+    )
+
+
+def pbe_correlation_H_and_derivatives(xp, f_pw, phi, t, beta, gamma):
+    """PBE H and its derivatives over (f_pw, phi, t, beta, gamma)"""
+    phi3 = phi**3
+    w = -f_pw / (gamma * phi3)
+    unclamped = w < MAX_EXPONENT
+    expm1 = xp.expm1(xp.where(unclamped, w, MAX_EXPONENT))
+    A = beta / (gamma * expm1)
+    t2 = t**2
+    f1 = t2 + A * t2**2
+    q = A * f1 + 1
+    f2 = beta * f1 / (gamma * q)
+    f2_log = xp.where(f2 <= -1, f2 + EPS_LOG, f2)
+    log = xp.log1p(f2_log)
+
+    d_f2 = gamma * phi3 / (1 + f2_log)
+    d_f1 = d_f2 * beta / (gamma * q**2)
+    d_A = -d_f2 * beta * f1**2 / (gamma * q**2) + d_f1 * t2**2
+    d_w = xp.where(unclamped, -d_A * A / expm1 * (expm1 + 1), 0)
+    d_f_pw = -d_w / (gamma * phi3)
+    d_phi = 3 * phi**2 * (gamma * log - d_w * w / phi3)
+    d_t = d_f1 * (2 * t + 4 * A * t2 * t)
+    d_beta = d_f2 * f1 / (gamma * q) + d_A / (gamma * expm1)
+    d_gamma = phi3 * log - d_f2 * f2 / gamma - d_A * A / gamma - d_w * w / gamma
+    return gamma * phi3 * log, d_f_pw, d_phi, d_t, d_beta, d_gamma
+
+
+def pbe_xc_and_derivatives(
+    xp,
+    rho_a,
+    rho_b,
+    sigma_aa,
+    sigma_ab,
+    sigma_bb,
+    beta,
+    gamma,
+    kappa_a,
+    mu_a,
+    kappa_b,
+    mu_b,
+):
+    """
+    pbe_xc and its derivatives with respect to the eleven arguments after xp
+    """
+    density = rho_a + rho_b + EPS_ADD
+    rs = (3 / (density * (4 * np.pi))) ** (1 / 3)
+    sqrt_rs = xp.sqrt(rs)
+    z = (rho_a - rho_b) / density
+
+    xs0 = xp.sqrt(sigma_aa + EPS_ADD_SIGMA) / (rho_a + EPS_ADD_RHO) ** (4 / 3)
+    xs1_b = xp.sqrt(sigma_bb + EPS_ADD_SIGMA) / (rho_b + EPS_ADD_RHO) ** (4 / 3)
+    # Last sigma and last rho equal 0
+    only_a = (sigma_bb < EPS) & (rho_b < EPS)
+    xs1 = xp.where(only_a, xs0, xs1_b)
+    sigma = sigma_aa + 2 * sigma_ab + sigma_bb + EPS_ADD_SIGMA
+    xt = xp.sqrt(sigma) / (rho_a + rho_b + EPS_ADD_RHO) ** (4 / 3)
+
+    # Exchange
+    zp, zm = (1 + z) ** (1 / 3), (1 - z) ** (1 / 3)
+    lda_prefactor = PBE_LDA_X_FACTOR * 2 ** (-4 / 3) * RS_FACTOR / rs
+    lda_a, lda_b = lda_prefactor * zp**4, lda_prefactor * zm**4
+    f_a, df_a_dx, df_a_dkappa, df_a_dmu = pbe_enhancement_and_derivatives(
+        xs0, kappa_a, mu_a
+    )
+    f_b, df_b_dx, df_b_dkappa, df_b_dmu = pbe_enhancement_and_derivatives(
+        xs1, kappa_b, mu_b
+    )
+    exchange = lda_a * f_a + lda_b * f_b
+
+    # PW92
+    g0, dg0 = pw_g_and_derivative(xp, 0, rs, sqrt_rs)
+    g1, dg1 = pw_g_and_derivative(xp, 1, rs, sqrt_rs)
+    g2, dg2 = pw_g_and_derivative(xp, 2, rs, sqrt_rs)
+    f_zeta = (zp**4 + zm**4 - 2) / (2 ** (4 / 3) - 2)
+    df_zeta = 4 / 3 * (zp - zm) / (2 ** (4 / 3) - 2)
+    z4 = z**4
+    spin_term = g1 - g0 + g2 / FZ20
+    f_pw = g0 + z4 * f_zeta * spin_term - f_zeta * g2 / FZ20
+    df_pw_drs = dg0 + z4 * f_zeta * (dg1 - dg0 + dg2 / FZ20) - f_zeta * dg2 / FZ20
+    df_pw_dz = (4 * z**3 * f_zeta + z4 * df_zeta) * spin_term - df_zeta * g2 / FZ20
+
+    # PBE H
+    phi = (zp**2 + zm**2) / 2
+    dphi = (1 / zp - 1 / zm) / 3
+    t_denominator = 4 * 2 ** (1 / 3) * phi * sqrt_rs
+    t = xt / t_denominator
+    H, d_f_pw, d_phi, d_t, d_beta, d_gamma = pbe_correlation_H_and_derivatives(
+        xp, f_pw, phi, t, beta, gamma
+    )
+
+    # Chain rule back to the arguments
+    d_f_pw = 1 + d_f_pw
+    d_rs = -d_t * t / (2 * rs) + d_f_pw * df_pw_drs - exchange / rs
+    d_z = (
+        (d_phi - d_t * t / phi) * dphi
+        + d_f_pw * df_pw_dz
+        + 4 / 3 * lda_prefactor * (f_a * zp - f_b * zm)
+    )
+    d_xt = d_t / t_denominator
+    d_xs0 = lda_a * df_a_dx + xp.where(only_a, lda_b * df_b_dx, 0)
+    d_xs1_b = xp.where(only_a, 0, lda_b * df_b_dx)
+
+    d_sigma = d_xt * xt / (2 * sigma)
+    d_rho_t = -4 / 3 * d_xt * xt / (rho_a + rho_b + EPS_ADD_RHO)
+    d_density = -d_rs * rs / (3 * density) - d_z * z / density
+    d_rho_a = (
+        d_density
+        + d_z / density
+        + d_rho_t
+        - 4 / 3 * d_xs0 * xs0 / (rho_a + EPS_ADD_RHO)
+    )
+    d_rho_b = (
+        d_density
+        - d_z / density
+        + d_rho_t
+        - 4 / 3 * d_xs1_b * xs1_b / (rho_b + EPS_ADD_RHO)
+    )
+    d_sigma_aa = d_sigma + d_xs0 * xs0 / (2 * (sigma_aa + EPS_ADD_SIGMA))
+    d_sigma_bb = d_sigma + d_xs1_b * xs1_b / (2 * (sigma_bb + EPS_ADD_SIGMA))
+
+    return exchange + f_pw + H, (
+        d_rho_a,
+        d_rho_b,
+        d_sigma_aa,
+        2 * d_sigma,
+        d_sigma_bb,
+        d_beta,
+        d_gamma,
+        lda_a * df_a_dkappa,
+        lda_a * df_a_dmu,
+        lda_b * df_b_dkappa,
+        lda_b * df_b_dmu,
+    )
+
+
+def pbe_xc_unpolarized_and_derivatives(xp, rho, sigma, beta, gamma, kappa, mu):
+    """
+    pbe_xc_unpolarized and its derivatives with respect to the six arguments
+    after xp
+    """
+    density = rho + EPS_ADD
+    rs = (3 / (density * (4 * np.pi))) ** (1 / 3)
+    sqrt_rs = xp.sqrt(rs)
+    rho_s = rho / 2 + EPS_ADD_RHO
+    sigma_s = sigma / 4 + EPS_ADD_SIGMA
+    xs = xp.sqrt(sigma_s) / rho_s ** (4 / 3)
+    xt = xp.sqrt(sigma + EPS_ADD_SIGMA) / (rho + EPS_ADD_RHO) ** (4 / 3)
+
+    lda = 2 * PBE_LDA_X_FACTOR * 2 ** (-4 / 3) * RS_FACTOR / rs
+    f, df_dx, df_dkappa, df_dmu = pbe_enhancement_and_derivatives(xs, kappa, mu)
+    g0, dg0 = pw_g_and_derivative(xp, 0, rs, sqrt_rs)
+    t_denominator = 4 * 2 ** (1 / 3) * sqrt_rs
+    t = xt / t_denominator
+    H, d_f_pw, _, d_t, d_beta, d_gamma = pbe_correlation_H_and_derivatives(
+        xp, g0, 1, t, beta, gamma
+    )
+
+    d_rs = -d_t * t / (2 * rs) + (1 + d_f_pw) * dg0 - lda * f / rs
+    d_xs = lda * df_dx
+    d_xt = d_t / t_denominator
+    d_rho = (
+        -d_rs * rs / (3 * density)
+        - 2 / 3 * d_xs * xs / rho_s
+        - 4 / 3 * d_xt * xt / (rho + EPS_ADD_RHO)
+    )
+    d_sigma = d_xs * xs / (8 * sigma_s) + d_xt * xt / (2 * (sigma + EPS_ADD_SIGMA))
+    return lda * f + g0 + H, (
+        d_rho,
+        d_sigma,
+        d_beta,
+        d_gamma,
+        lda * df_dkappa,
+        lda * df_dmu,
+    )
+
+
+def xalpha_xc_and_derivatives(xp, rho, alpha):
+    """
+    xalpha_xc and its derivatives with respect to (rho, alpha)
+    """
+    lda = LDA_X_FACTOR * (rho + EPS) ** (1 / 3)
+    energy = alpha * lda
+    return energy, (energy / (3 * (rho + EPS)), lda)
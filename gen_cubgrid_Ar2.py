@@ -4,21 +4,26 @@ import plotly
 import plotly.graph_objects as go
 import pylibxc as xc
 import torch
-from pyscf import dft, gto, lib
+from pyscf import dft, gto
 
 import density_functional_approximation_dm21 as dm21
+from density_functional_approximation_dm21.density_cache import (
+    initial_guess,
+    store_converged,
+)
+from density_functional_approximation_dm21.threads import configure_threads
 
 func_dict = {
-    "NN_PBE": dm21.NN_FUNCTIONAL("NN_PBE_18"),
-    "NN_PBE*": dm21.NN_FUNCTIONAL("NN_PBE_star"),
-    "NN_XALPHA": dm21.NN_FUNCTIONAL("NN_XALPHA_99"),
+    "NN_PBE": "NN_PBE_18",
+    "NN_PBE*": "NN_PBE_star",
+    "NN_XALPHA": "NN_XALPHA_99",
 }
 
 ldax = xc.LibXCFunctional("lda_x", "unpolarized")
 
 
 max_memory = 8000
-lib.num_threads(6)
+configure_threads()
 
 ni = dft.numint.NumInt()
 
@@ -36,7 +41,8 @@ mol.build()
 mf = dft.RKS(mol)
 mf.xc = "PBE0"
 mf.grids.level = 6
-mf.run()
+mf.run(initial_guess(mf, "PBE0"))
+store_converged(mf, "PBE0")
 
 spacex = np.linspace(0, 0, int(1))
 spacey = np.linspace(0, 0, int(1))
@@ -103,7 +109,7 @@ for i, func in enumerate(funcs):
 nn_funcs = ["NN_PBE", "NN_PBE*", "NN_XALPHA"]
 
 for i, func in enumerate(nn_funcs):
-    functional = func_dict[func]
+    functional = dm21.NN_FUNCTIONAL(func_dict[func])
 
     exc = (
         functional(features=inp, device=torch.device("cpu"), mode="Enhancement")[1]
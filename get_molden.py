@@ -1,15 +1,20 @@
 import os
 from optparse import OptionParser
 
-from pyscf import gto, lib, scf
+from pyscf import gto, scf
 from pyscf.gto.basis import parse_gaussian
 from pyscf.tools import wfn_format
 
+from density_functional_approximation_dm21.density_cache import (
+    initial_guess,
+    store_converged,
+)
 from density_functional_approximation_dm21.functional import NN_FUNCTIONAL
+from density_functional_approximation_dm21.threads import configure_threads
 
 
 def main():
-    lib.num_threads(4)
+    configure_threads()
     parser = OptionParser()
     parser.add_option("--Molecule", type=str, help="Molecule formula", default=None)
     parser.add_option("--Atom", type=str, help="Atom name", default=None)
@@ -20,12 +25,19 @@ def main():
         default="PBE0",
         help="Functional to calculate densities",
     )
+    parser.add_option(
+        "--Newton",
+        action="store_true",
+        default=False,
+        help="Second-order SCF for NN functionals",
+    )
 
     (Opts, args) = parser.parse_args()
     molecule_name = Opts.Molecule
     atom_name = Opts.Atom
     charge = Opts.Charge
     functional = Opts.Functional
+    newton = Opts.Newton
 
     # Initialize molecule
     mol = gto.Mole()
@@ -65,8 +77,10 @@ def main():
         mf.xc = functional
         functional += "_pyscf"
     else:
-        model = NN_FUNCTIONAL(functional)
+        model = NN_FUNCTIONAL(functional, max_memory=mf.max_memory)
         mf.define_xc_(model.eval_xc, "MGGA")
+        if newton:
+            mf = mf.newton()
 
     scf_data = {"latest_delta_e": None, "latest_g_norm": None}
 
@@ -84,7 +98,8 @@ def main():
     else:
         mf.grids.atom_grid = (155, 974)
     mf.max_cycle = 25
-    mf.run()
+    mf.run(initial_guess(mf, Opts.Functional))
+    store_converged(mf, Opts.Functional)
 
     if not mf.converged:
         latest_delta_e = scf_data["latest_delta_e"]
@@ -0,0 +1,323 @@
+import glob
+import math
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+from density_functional_approximation_dm21.model_paths import omega_family
+from results_db import read_energies, read_results
+from script import read_system_list, system_molecule
+
+# Single-CPU wall time (s) of one SCF = exp(a) * nao^b * natm^c. The default
+# (b, c) = (2, 1) is calibrated on NN_PBE_star def2-QZVP SCFs of seven Diet
+# species (H2O to MeI, 7 to 96 s, within a factor of 2)
+DEFAULT_COST_MODEL = (-8.06, 2.0, 1.0)
+# Distinct recorded systems, and the ratio of their largest to smallest basis,
+# needed to fit the exponents as well. With fewer, or with a rank-deficient
+# design (e.g. nao growing with natm alone), only the prefactor is fitted
+MIN_SYSTEMS = 8
+MIN_NAO_RANGE = 4
+# Part of an SCF that does not get faster with more CPUs
+SERIAL_FRACTION = 0.1
+CPU_CHOICES = (1, 2, 4, 8, 16)
+# Requested wall time relative to the predicted one
+TIME_MARGIN = 1.5
+
+job_template = """#! /bin/bash
+#SBATCH --job-name="E {job_name}"
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --time={minutes}
+#SBATCH --hint=nomultithread
+#SBATCH --output="{log_dir}/{job_name}_"%j.out
+# Executable
+python -m batch --Systems {system_list} --Functionals {functionals} --Workers {workers}"""
+
+
+def speedup(cpus):
+    """Speed-up of one SCF on cpus threads (Amdahl, SERIAL_FRACTION serial)"""
+    return 1 / (SERIAL_FRACTION + (1 - SERIAL_FRACTION) / cpus)
+
+
+def system_features(system_names):
+    """{system: (basis functions, atoms)}; systems without a GIF are left out"""
+    features = {}
+    for system_name in system_names:
+        try:
+            molecule = system_molecule(system_name, verbose=0)
+        except Exception as E:
+            print(E)
+            continue
+        features[system_name] = (molecule.nao, molecule.natm)
+    return features
+
+
+def predicted_time(model, nao, natm):
+    """Single-CPU seconds of one SCF"""
+    log_prefactor, nao_exponent, natm_exponent = model
+    return math.exp(log_prefactor) * nao**nao_exponent * natm**natm_exponent
+
+
+def fit_cost_model(functionals, features):
+    """
+    Least-squares fit of log(single-CPU seconds) to log(nao) and log(natm)
+    over the successful records of functionals in the results database.
+    The wall times are scaled to one CPU with speedup and averaged (in log)
+    per system, so that each system counts once. The exponents are fitted
+    only with MIN_SYSTEMS systems spanning MIN_NAO_RANGE in nao and a full
+    rank design; otherwise the prefactor is fitted with the exponents of
+    DEFAULT_COST_MODEL. Returns DEFAULT_COST_MODEL without records.
+    """
+    log_times = {}
+    for functional in functionals:
+        for record in read_results(functional):
+            if record["energy"] is None or not record["wall_time"]:
+                continue
+            if record["system"] not in features:
+                continue
+            seconds = record["wall_time"] * speedup(record["threads"] or 1)
+            log_times.setdefault(record["system"], []).append(math.log(seconds))
+    if not log_times:
+        print("No recorded runs: default cost model")
+        return DEFAULT_COST_MODEL
+
+    systems = sorted(log_times)
+    nao = np.array([features[system][0] for system in systems], dtype=float)
+    natm = np.array([features[system][1] for system in systems], dtype=float)
+    log_time = np.array([np.mean(log_times[system]) for system in systems])
+    design = np.column_stack([np.ones(len(systems)), np.log(nao), np.log(natm)])
+    if (
+        len(systems) >= MIN_SYSTEMS
+        and nao.max() >= MIN_NAO_RANGE * nao.min()
+        and np.linalg.matrix_rank(design) == 3
+    ):
+        model = tuple(np.linalg.lstsq(design, log_time, rcond=None)[0].tolist())
+        print(f"Cost model fitted on {len(systems)} recorded systems: {model}")
+        return model
+
+    _, nao_exponent, natm_exponent = DEFAULT_COST_MODEL
+    log_prefactor = np.mean(
+        log_time - nao_exponent * design[:, 1] - natm_exponent * design[:, 2]
+    )
+    print(
+        f"Cost model prefactor fitted on {len(systems)} recorded systems: "
+        f"{log_prefactor:.2f}"
+    )
+    return (float(log_prefactor), nao_exponent, natm_exponent)
+
+
+def pending_costs(system_names, functionals, model, features):
+    """
+    {system: single-CPU seconds of its functionals without a result} and the
+    number of those (system, functional) calculations
+    """
+    finished = {f: set(read_energies(f)) for f in functionals}
+    costs, items = {}, 0
+    for system_name in system_names:
+        if system_name not in features:
+            continue
+        pending = [f for f in functionals if system_name not in finished[f]]
+        items += len(pending)
+        if pending:
+            costs[system_name] = len(pending) * predicted_time(
+                model, *features[system_name]
+            )
+    return costs, items
+
+
+def pack_jobs(costs, time_limit, max_cpus=16, small_job_cpus=4):
+    """
+    Jobs {"cpus", "workers", "systems", "time"} for costs ({system:
+    single-CPU seconds}) within time_limit seconds each.
+
+    A system that cannot finish on one CPU within time_limit gets a job of
+    its own with the fewest CPUs (up to max_cpus) that can finish it. The
+    other systems are packed, largest first, into jobs of small_job_cpus
+    single-threaded workers: each system goes to the least loaded worker of
+    the first job that still ends within time_limit.
+    """
+    jobs = []
+    packed = []
+    for system_name, cost in sorted(costs.items(), key=lambda item: -item[1]):
+        if cost > time_limit:
+            choices = [n for n in CPU_CHOICES if n <= max_cpus]
+            cpus = next(
+                (n for n in choices if cost / speedup(n) <= time_limit), choices[-1]
+            )
+            jobs.append(
+                {
+                    "cpus": cpus,
+                    "workers": 1,
+                    "systems": [system_name],
+                    "time": cost / speedup(cpus),
+                }
+            )
+            continue
+
+        for job in packed:
+            loads = job["loads"]
+            worker = loads.index(min(loads))
+            if loads[worker] + cost <= time_limit:
+                break
+        else:
+            job = {"loads": [0.0] * small_job_cpus, "systems": []}
+            packed.append(job)
+            worker = 0
+        job["loads"][worker] += cost
+        job["systems"].append(system_name)
+
+    for job in packed:
+        # Fewer systems than workers leave nothing for the extra CPUs
+        workers = min(small_job_cpus, len(job["systems"]))
+        jobs.append(
+            {
+                "cpus": workers,
+                "workers": workers,
+                "systems": job["systems"],
+                "time": max(job["loads"]),
+            }
+        )
+    return jobs
+
+
+def check_jobs(jobs, costs, time_limit, max_cpus):
+    """Problems of a packing: systems missing or repeated, limits exceeded"""
+    problems = []
+    counts = {}
+    for job in jobs:
+        for system_name in job["systems"]:
+            counts[system_name] = counts.get(system_name, 0) + 1
+        if job["cpus"] > max_cpus:
+            problems.append(f"{job['systems']} on {job['cpus']} > {max_cpus} CPUs")
+        if job["time"] > time_limit:
+            problems.append(
+                f"{job['systems']} predicted {job['time'] / 3600:.1f} h "
+                f"on {job['cpus']} CPUs, over the limit"
+            )
+    for system_name in costs:
+        if counts.get(system_name) != 1:
+            problems.append(f"{system_name} in {counts.get(system_name, 0)} jobs")
+    return problems
+
+
+def summarize(jobs, costs, items, cpus_per_job=4):
+    """
+    Jobs, predicted CPU hours reserved and idle fraction of the packing
+    against one cpus_per_job job for each of the items calculations
+    """
+    reserved = sum(job["cpus"] * job["time"] for job in jobs)
+    work = sum(costs.values())
+    per_item = cpus_per_job * work / speedup(cpus_per_job)
+    print(
+        f"{len(jobs)} jobs instead of {items}: "
+        f"{reserved / 3600:.1f} CPU hours reserved ({1 - work / reserved:.0%} idle) "
+        f"instead of {per_item / 3600:.1f} ({1 - work / per_item:.0%} idle)"
+    )
+
+
+def write_jobs(jobs, functionals, job_dir="Jobs", log_dir="log_files"):
+    """Writes job_{i}.slurm and its system list job_{i}.txt; returns the scripts"""
+    os.makedirs(job_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(job_dir, "job_*")):
+        os.remove(stale)
+
+    scripts = []
+    for i, job in enumerate(jobs):
+        job_name = f"job_{i:03d}"
+        system_list = os.path.join(job_dir, f"{job_name}.txt")
+        with open(system_list, "w") as file:
+            file.writelines(f"{name}.gif_\n" for name in job["systems"])
+
+        script = os.path.join(job_dir, f"{job_name}.slurm")
+        with open(script, "w") as file:
+            file.write(
+                job_template.format(
+                    job_name=job_name,
+                    cpus=job["cpus"],
+                    minutes=max(math.ceil(job["time"] * TIME_MARGIN / 60), 10),
+                    log_dir=log_dir,
+                    system_list=system_list,
+                    functionals=",".join(functionals),
+                    workers=job["workers"],
+                )
+            )
+        scripts.append(script)
+    return scripts
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option(
+        "--Systems",
+        type=str,
+        default=None,
+        help="List of systems (default: GIF/FullList_{NFinal}.txt)",
+    )
+    parser.add_option(
+        "--Functionals",
+        type=str,
+        default="",
+        help="Comma separated functionals (NN checkpoints or PySCF xc names)",
+    )
+    parser.add_option(
+        "--Family",
+        type=str,
+        default=None,
+        help="NN_PBE or NN_XALPHA: add the omega checkpoints found on disk",
+    )
+    parser.add_option(
+        "--Hours", type=float, default=4.0, help="Predicted wall time limit per job"
+    )
+    parser.add_option(
+        "--MaxCpus", type=int, default=16, help="CPUs of the largest jobs"
+    )
+    parser.add_option(
+        "--SmallJobCpus",
+        type=int,
+        default=4,
+        help="Workers of the jobs packing several small systems",
+    )
+    parser.add_option("--JobDir", type=str, default="Jobs", help="Job scripts folder")
+    parser.add_option(
+        "--LogDir", type=str, default="log_files", help="Job logs folder"
+    )
+    parser.add_option(
+        "--Submit",
+        action="store_true",
+        default=False,
+        help="Submit the jobs with sbatch (default: only write and check them)",
+    )
+    parser.add_option(
+        "--NFinal", type=int, default=30, help="Number of systems to select"
+    )
+
+    (Opts, args) = parser.parse_args()
+
+    functionals = [name for name in Opts.Functionals.split(",") if name]
+    if Opts.Family:
+        functionals += omega_family(Opts.Family, on_disk=True)
+    # A checkpoint given in --Functionals and --Family is evaluated once
+    functionals = list(dict.fromkeys(functionals))
+    system_list = Opts.Systems or f"GIF/FullList_{Opts.NFinal}.txt"
+    system_names = read_system_list(system_list)
+    time_limit = Opts.Hours * 3600
+
+    features = system_features(system_names)
+    model = fit_cost_model(functionals, features)
+    costs, items = pending_costs(system_names, functionals, model, features)
+    if not costs:
+        print("Nothing to calculate")
+        raise SystemExit
+
+    jobs = pack_jobs(costs, time_limit, Opts.MaxCpus, Opts.SmallJobCpus)
+    for problem in check_jobs(jobs, costs, time_limit, Opts.MaxCpus):
+        print(f"Warning: {problem}")
+    summarize(jobs, costs, items)
+
+    os.makedirs(Opts.LogDir, exist_ok=True)
+    for script in write_jobs(jobs, functionals, Opts.JobDir, Opts.LogDir):
+        print(script)
+        if Opts.Submit:
+            os.system(f"sbatch {script}")
@@ -19,9 +19,9 @@ df = {
 }
 
 func_dict = {
-    "NN_PBE": dm21.NN_FUNCTIONAL("NN_PBE_18"),
-    "NN_PBE*": dm21.NN_FUNCTIONAL("NN_PBE_star"),
-    "NN_XALPHA": dm21.NN_FUNCTIONAL("NN_XALPHA_99"),
+    "NN_PBE": "NN_PBE_18",
+    "NN_PBE*": "NN_PBE_star",
+    "NN_XALPHA": "NN_XALPHA_99",
 }
 
 
@@ -67,7 +67,7 @@ def get_tr(rs, s, alpha, func, color, dash):
 
 def get_tr_NN(rs, s, alpha, func, color, dash):
 
-    functional = func_dict[func]
+    functional = dm21.NN_FUNCTIONAL(func_dict[func])
 
     rho = 3 / (rs**3 * 4 * np.pi)
 
@@ -0,0 +1,133 @@
+from optparse import OptionParser
+
+import numpy as np
+
+from density_functional_approximation_dm21.dispersion_store import dispersion_energy
+from density_functional_approximation_dm21.ensemble import ensembles, grid_densities
+from density_functional_approximation_dm21.model_paths import (
+    omega_family,
+    relative_path_to_model_state_dict,
+)
+from density_functional_approximation_dm21.threads import configure_threads
+from script import (
+    get_coords_charge_spin,
+    get_PBE0_density,
+    initialize_molecule,
+    write_energy,
+)
+
+
+def non_xc_energy(mf, dm):
+    """Nuclear repulsion, one-electron and Coulomb energy of density matrix dm"""
+    dm_total = dm if dm.ndim == 2 else dm[0] + dm[1]
+    h1e = mf.get_hcore()
+    vj = mf.get_j(mf.mol, dm_total)
+    return mf.energy_nuc() + np.einsum("ij,ji", h1e + vj / 2, dm_total)
+
+
+def reference_density(system_name, density_fit=False):
+    """
+    Converged PBE0 density of system_name in its grid layout: rho, spin,
+    weights, and the XC-free part of the total energy plus D3(BJ)
+    """
+    coords, charge, spin = get_coords_charge_spin(system_name)
+    _, mf = initialize_molecule(coords, charge, spin, density_fit)
+    mf.chkfile = None
+    mf, dm = get_PBE0_density(mf)
+
+    blocks = list(grid_densities(mf, dm))
+    rho = np.concatenate([rho for rho, _ in blocks], axis=-1)
+    weights = np.concatenate([weights for _, weights in blocks])
+
+    d3_energy = dispersion_energy(mf.mol, "PBE0")
+    return rho, int(spin > 0), weights, non_xc_energy(mf, dm) + d3_energy
+
+
+def non_self_consistent_energies(
+    system_names, functionals, density_fit=False, xc_threads=None
+):
+    """
+    {functional: {system: energy}} of the NN checkpoints functionals at the
+    PBE0 density, D3(BJ) included. The NN XC energy is evaluated without
+    derivatives, on the grids of all systems at once with xc_threads torch
+    threads; systems whose reference SCF fails get "ERROR".
+    """
+    references = {}
+    for system_name in system_names:
+        print("\n\n", system_name, "\n\n")
+        try:
+            references[system_name] = reference_density(system_name, density_fit)
+        except Exception as E:
+            print(E)
+
+    energies = {
+        functional: dict.fromkeys(system_names, "ERROR") for functional in functionals
+    }
+    if not references:
+        return energies
+
+    densities = [reference[:3] for reference in references.values()]
+    for ensemble in ensembles(functionals, num_threads=xc_threads):
+        xc_energies = ensemble.batch_energies(densities)
+        for functional, row in zip(ensemble.names, xc_energies):
+            for (system_name, reference), xc_energy in zip(references.items(), row):
+                energies[functional][system_name] = reference[3] + xc_energy
+    return energies
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+
+    parser.add_option(
+        "--Functionals", type=str, default="", help="Comma separated NN checkpoints"
+    )
+    parser.add_option(
+        "--Family",
+        type=str,
+        default=None,
+        help="NN_PBE or NN_XALPHA: add the omega checkpoints found on disk",
+    )
+    parser.add_option("--Systems", type=str, help="Comma separated systems")
+    parser.add_option(
+        "--Threads",
+        type=int,
+        default=None,
+        help="Threads for PySCF and torch (default: CPUs allotted to the job)",
+    )
+    parser.add_option(
+        "--XCThreads",
+        type=int,
+        default=None,
+        help="torch threads for the NN XC evaluation (default: --Threads)",
+    )
+    parser.add_option(
+        "--DensityFit",
+        action="store_true",
+        default=False,
+        help="Density-fitted (JK) PBE0 reference densities",
+    )
+
+    (Opts, args) = parser.parse_args()
+
+    functionals = [name for name in Opts.Functionals.split(",") if name]
+    if Opts.Family:
+        functionals += omega_family(Opts.Family, on_disk=True)
+    # A checkpoint given in --Functionals and --Family is evaluated once
+    functionals = list(dict.fromkeys(functionals))
+
+    xc_threads = Opts.XCThreads or Opts.Threads
+    configure_threads(Opts.Threads, xc_threads)
+
+    energies = non_self_consistent_energies(
+        Opts.Systems.split(","), functionals, Opts.DensityFit, xc_threads
+    )
+    for functional in functionals:
+        checkpoint = relative_path_to_model_state_dict.get(functional)
+        for system_name, energy in energies[functional].items():
+            write_energy(
+                system_name,
+                f"{functional}_NSCF",
+                energy,
+                Opts.DensityFit,
+                checkpoint=checkpoint,
+            )
@@ -0,0 +1,150 @@
+import os
+import re
+import sqlite3
+from contextlib import closing
+from optparse import OptionParser
+
+# One SQLite file shared by all jobs. It keeps the default rollback journal:
+# WAL needs shared memory, which jobs on different nodes do not have.
+results_db_path = os.environ.get("NN_FUNCTIONAL_RESULTS_DB", "Results/results.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    system TEXT NOT NULL,
+    functional TEXT NOT NULL,
+    energy REAL,
+    d3 REAL,
+    cycles INTEGER,
+    converged INTEGER,
+    wall_time REAL,
+    threads INTEGER,
+    checkpoint TEXT,
+    error TEXT,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (system, functional)
+);
+CREATE INDEX IF NOT EXISTS results_functional ON results (functional);
+"""
+
+# Besides the key: total energy (Hartree, D3 included, NULL on failure), D3
+# part of it, SCF cycles, convergence flag, seconds, threads, checkpoint file,
+# error
+FIELDS = (
+    "energy",
+    "d3",
+    "cycles",
+    "converged",
+    "wall_time",
+    "threads",
+    "checkpoint",
+    "error",
+)
+
+
+def connect(path=None):
+    """Connection to the results database, created on first use"""
+    path = path or results_db_path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Jobs finishing together wait for each other's transactions
+    connection = sqlite3.connect(path, timeout=600)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def write_results(records, path=None):
+    """
+    Stores records ({"system", "functional", and any of FIELDS}) in one
+    transaction. A record replaces the one with the same system and
+    functional, so reruns never produce duplicates.
+    """
+    columns = ("system", "functional") + FIELDS
+    assignments = ", ".join(f"{field} = excluded.{field}" for field in FIELDS)
+    statement = (
+        f"INSERT INTO results ({', '.join(columns)}, updated) "
+        f"VALUES ({', '.join('?' * len(columns))}, datetime('now')) "
+        f"ON CONFLICT (system, functional) DO UPDATE SET {assignments}, "
+        "updated = excluded.updated"
+    )
+    rows = [[record.get(column) for column in columns] for record in records]
+    with closing(connect(path)) as connection, connection:
+        connection.executemany(statement, rows)
+
+
+def write_result(system, functional, energy=None, path=None, **fields):
+    """Stores the result of one calculation; energy None records a failure"""
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise TypeError(f"Unknown result fields {sorted(unknown)}")
+    record = dict(fields, system=system, functional=functional, energy=energy)
+    write_results([record], path)
+
+
+def read_results(functional=None, system=None, path=None):
+    """Records (dicts) of functional and/or system, all of them by default"""
+    conditions, values = [], []
+    for column, value in (("functional", functional), ("system", system)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            values.append(value)
+    statement = "SELECT * FROM results"
+    if conditions:
+        statement += " WHERE " + " AND ".join(conditions)
+    with closing(connect(path)) as connection:
+        return [dict(row) for row in connection.execute(statement, values)]
+
+
+def read_energies(functional, path=None):
+    """{system: energy} of the successful calculations with functional"""
+    with closing(connect(path)) as connection:
+        rows = connection.execute(
+            "SELECT system, energy FROM results "
+            "WHERE functional = ? AND energy IS NOT NULL",
+            (functional,),
+        )
+        return dict(rows.fetchall())
+
+
+def import_energy_list(filename, functional=None, path=None):
+    """
+    Records of a Results/EnergyList_{NFinal}_{functional}.txt file, the
+    functional taken from the file name by default. Later lines of a system
+    replace earlier ones; "ERROR" lines are stored as failures.
+    """
+    if functional is None:
+        match = re.fullmatch(r"EnergyList_\d+_(.+)\.txt", os.path.basename(filename))
+        if match is None:
+            raise ValueError(f"No functional in the file name {filename}")
+        functional = match.group(1)
+
+    records = {}
+    with open(filename, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            system, energy = line.split()
+            system = system.removesuffix(".gif_")
+            record = {"system": system, "functional": functional}
+            if energy == "ERROR":
+                record["error"] = energy
+            else:
+                record["energy"] = float(energy)
+            records[system] = record
+    write_results(records.values(), path)
+    return len(records)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [EnergyList files to import]")
+    parser.add_option(
+        "--Functional",
+        type=str,
+        default=None,
+        help="Functional of the imported files (default: from their names)",
+    )
+
+    (Opts, args) = parser.parse_args()
+
+    for filename in args:
+        count = import_energy_list(filename, Opts.Functional)
+        print(f"{filename}: {count} systems imported into {results_db_path}")
@@ -1,27 +1,56 @@
+import time
 from optparse import OptionParser
 
-import dftd3.pyscf as disp
 from pyscf import dft, gto, lib
 
-from density_functional_approximation_dm21.functional import NN_FUNCTIONAL
+import density_functional_approximation_dm21
+from benchmark_store import species_geometry
+from density_functional_approximation_dm21.density_cache import (
+    initial_guess,
+    store_converged,
+)
+from density_functional_approximation_dm21.dispersion_store import (
+    PARAMETRIZATIONS,
+    compute_dispersions,
+    dispersion_energy,
+)
+from density_functional_approximation_dm21.model_paths import (
+    relative_path_to_model_state_dict,
+)
+from density_functional_approximation_dm21.scf_convergence import (
+    FIRST_ORDER_STAGES,
+    NEWTON_STAGES,
+    STAGES,
+    converge,
+)
+from density_functional_approximation_dm21.threads import configure_threads
+from results_db import write_result
+
+# Auxiliary bases of the density-fitting mode: the def2 universal J fitting set
+# (def2/J, ECP elements included) for RI-J, and the def2-QZVP JK fitting set
+# when exact exchange is fitted too
+AUXBASIS = {"J": "def2-universal-jfit", "JK": "def2-qzvp-jkfit"}
+
+# Cycle cap of each float32 stage of the mixed-precision mode
+MIXED_PRECISION_MAX_CYCLE = 15
+
+
+def read_system_list(path):
+    """System names from a list of .gif_ files such as GIF/FullList_{NFinal}.txt"""
+    with open(path, "r") as file:
+        return [line.strip().removesuffix(".gif_") for line in file if line.strip()]
 
 
 def get_coords_charge_spin(system_name):
-    with open(f"GIF/{system_name}/{system_name}.gif_", "r") as file:
-        coords = ""
-
-        lines = file.readlines()
-        for line in lines[3:]:
-            coords += " ".join(line.split()) + "\n"
-
-        charge, spin = map(int, lines[2].split())
-
-        coords = coords[:-1]
-        spin = spin - 1
-    return coords, charge, spin
+    elements, positions, charge, multiplicity = species_geometry(system_name)
+    coords = "\n".join(
+        f"{element} {x:.5f} {y:.5f} {z:.5f}"
+        for element, (x, y, z) in zip(elements, positions)
+    )
+    return coords, charge, multiplicity - 1
 
 
-def initialize_molecule(coords, charge, spin):
+def initialize_molecule(coords, charge, spin, density_fit=False, verbose=4):
     ecp_atoms = []
     molecule = gto.Mole()
     molecule.atom = coords
@@ -34,111 +63,239 @@ def initialize_molecule(coords, charge, spin):
 
     molecule.ecp = {atom: "def2-qzvp" for atom in ecp_atoms}
     molecule.basis = "def2-qzvp"
-    molecule.verbose = 4
+    molecule.verbose = verbose
     molecule.spin = spin
     molecule.charge = charge
     molecule.symmetry = False
     molecule.build()
 
-    if spin == 0:
+    return molecule, initialize_scf(molecule, density_fit)
+
+
+def initialize_scf(molecule, density_fit=False):
+    if molecule.spin == 0:
         mf = dft.RKS(molecule)
     else:
         mf = dft.UKS(molecule)
+    if density_fit:
+        mf = mf.density_fit(auxbasis=AUXBASIS["J"])
 
     mf.max_cycle = 25
 
-    return molecule, mf
+    return mf
+
+
+def match_auxbasis(mf):
+    """In density-fitting mode, fit J and K with the JK set for hybrids"""
+    if getattr(mf, "with_df", None) is None:
+        return
+    auxbasis = AUXBASIS["JK" if mf._numint.libxc.is_hybrid_xc(mf.xc) else "J"]
+    if mf.with_df.auxbasis != auxbasis:
+        mf.with_df.auxbasis = auxbasis
+        mf.with_df.reset()
 
 
 def get_PBE0_density(mf):
     mf.xc = "PBE0"
-    mf.run()
+    match_auxbasis(mf)
+    mf.run(initial_guess(mf, "PBE0"))
+    store_converged(mf, "PBE0")
     dm0 = mf.make_rdm1()
 
     return mf, dm0
 
 
-def calculate_functional_energy(mf, functional_name, dm0=None, system_name=None):
+def calculate_functional_energy(
+    mf,
+    functional_name,
+    dm0=None,
+    system_name=None,
+    newton=False,
+    backend="torch",
+    precision="float64",
+    xc_threads=None,
+):
     print(functional_name)
-    model = NN_FUNCTIONAL(functional_name)
+    if dm0 is None:
+        dm0 = initial_guess(mf, functional_name)
+    early_cycles = 0
+    if backend == "numpy":
+        model = density_functional_approximation_dm21.NN_FUNCTIONAL_NUMPY(
+            functional_name, max_memory=mf.max_memory
+        )
+    else:
+        if precision == "mixed":
+            # Early SCF cycles with the float32 network, converged in float64
+            early_model = density_functional_approximation_dm21.NN_FUNCTIONAL(
+                functional_name,
+                max_memory=mf.max_memory,
+                precision="float32",
+                num_threads=xc_threads,
+            )
+            mf.define_xc_(early_model.eval_xc, "MGGA")
+            mf.conv_tol = 1e-4
+            max_cycle, mf.max_cycle = mf.max_cycle, MIXED_PRECISION_MAX_CYCLE
+            try:
+                converge(mf, dm0, FIRST_ORDER_STAGES)
+                early_cycles = mf.cycles
+                if mf.converged:
+                    dm0 = mf.make_rdm1()
+                else:
+                    # A float32 density that diverged or stalled is no better
+                    # a start than the initial guess
+                    print(
+                        f"float32 SCF not converged after {early_cycles} cycles, "
+                        "restarting from the initial guess in float64"
+                    )
+            except Exception as E:
+                early_cycles = getattr(mf, "cycles", 0)
+                print(f"float32 SCF failed: {E!r}, continuing in float64")
+            mf.max_cycle = max_cycle
+            precision = "float64"
+        model = density_functional_approximation_dm21.NN_FUNCTIONAL(
+            functional_name,
+            max_memory=mf.max_memory,
+            precision=precision,
+            num_threads=xc_threads,
+        )
     mf.define_xc_(model.eval_xc, "MGGA")
     mf.conv_tol = 1e-6
     mf.conv_tol_grad = 1e-3
 
-    energy = mf.kernel(dm0=dm0)
+    # DIIS, then ADIIS with damping and level shift, then SOSCF and smearing,
+    # switching as soon as the energy diverges, oscillates or stalls
+    if backend == "numpy":
+        stages = FIRST_ORDER_STAGES
+    elif newton:
+        stages = NEWTON_STAGES
+    else:
+        stages = STAGES
+    energy = converge(mf, dm0, stages)
+    # Cycles of both precisions of the mixed mode
+    mf.cycles += early_cycles
+    store_converged(mf, functional_name)
+    print(f"Density screening skipped {model.skipped_fraction:.1%} of grid points")
 
     if not mf.converged:
         with open("./non_converged_systems_gmtkn55.log", "a") as file:
             file.write(f"{functional_name}-{system_name}\n")
 
-    d3 = disp.DFTD3Dispersion(mf.mol, xc="PBE0", version="d3bj")
-    d3_energy = d3.kernel()[0]
+    d3_energy = dispersion_energy(mf.mol, "PBE0")
 
     return energy + d3_energy
 
 
-def calculate_non_nn_functional_energy(mf, functional_name):
+def calculate_non_nn_functional_energy(mf, functional_name, dm0=None):
     mf.xc = functional_name
+    match_auxbasis(mf)
     mf.conv_tol = 1e-6
     mf.conv_tol_grad = 1e-3
-    energy = mf.kernel()
+    if dm0 is None:
+        dm0 = initial_guess(mf, functional_name)
+    energy = mf.kernel(dm0=dm0)
+    store_converged(mf, functional_name)
 
-    d3 = disp.DFTD3Dispersion(mf.mol, xc=functional_name, version="d3bj")
-    d3_energy = d3.kernel()[0]
+    d3_energy = dispersion_energy(mf.mol, functional_name)
 
     return energy + d3_energy
 
 
-def main(system_name, functional, NFinal):
+def main(
+    system_name,
+    functional,
+    newton=False,
+    backend="torch",
+    precision="float64",
+    density_fit=False,
+    xc_threads=None,
+):
 
-    lib.num_threads(4)
     print("\n\n", system_name, "\n\n")
     coords, charge, spin = get_coords_charge_spin(system_name)
 
-    _, mf = initialize_molecule(coords, charge, spin)
+    _, mf = initialize_molecule(coords, charge, spin, density_fit)
     dm0 = None
 
     mf.chkfile = None
 
     print(f"\n\n{functional} calculation \n\n")
+    start, error = time.perf_counter(), None
     try:
         corrected_energy = calculate_functional_energy(
-            mf, functional, dm0=dm0, system_name=system_name
+            mf,
+            functional,
+            dm0=dm0,
+            system_name=system_name,
+            newton=newton,
+            backend=backend,
+            precision=precision,
+            xc_threads=xc_threads,
         )
     except Exception as E:
         print(E)
-        corrected_energy = "ERROR"
-    finally:
-        with open(f"Results/EnergyList_{NFinal}_{functional}.txt", "a") as file:
-            file.write(f"{system_name}.gif_ {corrected_energy}\n")
+        corrected_energy, error = "ERROR", str(E)
+    fields = result_fields(
+        mf, functional, corrected_energy, time.perf_counter() - start, error
+    )
+    write_energy(system_name, functional, corrected_energy, density_fit, **fields)
 
 
-def test_non_nn_functional(system_name, non_nn_functional, NFinal):
+def test_non_nn_functional(system_name, non_nn_functional, density_fit=False):
     print("Number of threads:", lib.num_threads())
     print("\n\n", system_name, "\n\n")
     coords, charge, spin = get_coords_charge_spin(system_name)
 
-    _, mf = initialize_molecule(coords, charge, spin)
+    _, mf = initialize_molecule(coords, charge, spin, density_fit)
 
+    start = time.perf_counter()
     energy = calculate_non_nn_functional_energy(mf, non_nn_functional)
 
-    with open(f"Results/EnergyList_{NFinal}_{functional}.txt", "a") as file:
-        file.write(f"{system_name}.gif_ {energy}\n")
+    fields = result_fields(mf, non_nn_functional, energy, time.perf_counter() - start)
+    write_energy(system_name, non_nn_functional, energy, density_fit, **fields)
 
 
-def calculate_dispersions():
-    print("Number of threads:", lib.num_threads())
-    print("\n\n", system_name, "\n\n")
+def result_label(functional, density_fit=False):
+    """Functional name of the results; density-fitted energies are kept apart"""
+    return f"{functional}_DF" if density_fit else functional
+
+
+def result_fields(mf, functional, energy, wall_time=None, error=None):
+    """Fields of the results database besides the energy, for a finished mf"""
+    fields = {
+        "checkpoint": relative_path_to_model_state_dict.get(functional),
+        "wall_time": wall_time,
+        "threads": lib.num_threads(),
+        "error": error,
+    }
+    if energy != "ERROR":
+        fields["d3"] = float(energy - mf.e_tot)
+        fields["cycles"] = getattr(mf, "cycles", None)
+        fields["converged"] = bool(mf.converged)
+    return fields
+
+
+def write_energy(system_name, functional, energy, density_fit=False, **fields):
+    """Records energy ("ERROR" for a failure) in the results database"""
+    if energy == "ERROR":
+        energy = None
+        fields["error"] = fields.get("error") or "ERROR"
+    else:
+        energy = float(energy)
+    write_result(system_name, result_label(functional, density_fit), energy, **fields)
+
+
+def system_molecule(system_name, verbose=4):
     coords, charge, spin = get_coords_charge_spin(system_name)
-    molecule, mf = initialize_molecule(coords, charge, spin)
-    d3_PBE0 = disp.DFTD3Dispersion(molecule, xc="PBE0", version="d3bj")
-    d3_PBE = disp.DFTD3Dispersion(molecule, xc="PBE", version="d3bj")
-    d3_PBE0_energy = d3_PBE0.kernel()[0]
-    d3_PBE_energy = d3_PBE.kernel()[0]
-    with open(f"Results/DispersionList_PBE0.txt", "a") as file:
-        file.write(f"{system_name}.gif_ {d3_PBE0_energy}\n")
-    with open(f"Results/DispersionList_PBE.txt", "a") as file:
-        file.write(f"{system_name}.gif_ {d3_PBE_energy}\n")
+    return initialize_molecule(coords, charge, spin, verbose=verbose)[0]
+
+
+def calculate_dispersions(system_names):
+    """
+    Fills the dispersion store with the PBE0 and PBE D3(BJ) energies of all
+    systems in one process; returns [{parametrization: energy}]
+    """
+    molecules = [system_molecule(system_name) for system_name in system_names]
+    return compute_dispersions(molecules, PARAMETRIZATIONS)
 
 
 if __name__ == "__main__":
@@ -148,9 +305,52 @@ if __name__ == "__main__":
         "--Functional", type=str, default="NN_PBE_0", help="Functional for calculation"
     )
     parser.add_option(
-        "--Dispersion", type=str, default=False, help="D3 Dispersion calculation"
+        "--Dispersion",
+        type=str,
+        default=False,
+        help="D3(BJ) dispersions of --System, or of all systems in "
+        "GIF/FullList_{NFinal}.txt, into the dispersion store",
     )
     parser.add_option("--System", type=str, help="System to calculate")
+    parser.add_option(
+        "--Newton",
+        action="store_true",
+        default=False,
+        help="Second-order SCF for NN functionals",
+    )
+    parser.add_option(
+        "--Backend",
+        type=str,
+        default="torch",
+        help="torch or numpy (first derivatives only, no --Newton)",
+    )
+    parser.add_option(
+        "--Precision",
+        type=str,
+        default="float64",
+        help="Network precision for the torch backend: float64, float32 or mixed "
+        "(float32 for the early SCF cycles)",
+    )
+    parser.add_option(
+        "--Threads",
+        type=int,
+        default=None,
+        help="Threads for PySCF and torch (default: CPUs allotted to the job)",
+    )
+    parser.add_option(
+        "--XCThreads",
+        type=int,
+        default=None,
+        help="torch threads for the NN XC evaluation (default: --Threads; "
+        "not with --Backend numpy)",
+    )
+    parser.add_option(
+        "--DensityFit",
+        action="store_true",
+        default=False,
+        help="Density fitting (RI-J; JK fitting for hybrids), results recorded "
+        "as {Functional}_DF",
+    )
     parser.add_option(
         "--NFinal", type=int, default=30, help="Number of systems to select"
     )
@@ -161,10 +361,36 @@ if __name__ == "__main__":
     functional = Opts.Functional
     dispersion = Opts.Dispersion
     NFinal = Opts.NFinal
+    newton = Opts.Newton
+    backend = Opts.Backend
+    precision = Opts.Precision
+    density_fit = Opts.DensityFit
+
+    if backend == "numpy" and Opts.XCThreads:
+        parser.error(
+            "--XCThreads sets torch threads, the numpy backend runs on --Threads"
+        )
+    xc_threads = Opts.XCThreads or Opts.Threads
+    configure_threads(
+        Opts.Threads,
+        xc_threads,
+        backend if "NN" in functional and not dispersion else None,
+    )
 
     if dispersion:
-        calculate_dispersions()
+        if system_name:
+            calculate_dispersions([system_name])
+        else:
+            calculate_dispersions(read_system_list(f"GIF/FullList_{NFinal}.txt"))
     elif "NN" in functional:
-        main(system_name, functional, NFinal)
+        main(
+            system_name,
+            functional,
+            newton=newton,
+            backend=backend,
+            precision=precision,
+            density_fit=density_fit,
+            xc_threads=xc_threads,
+        )
     else:
-        test_non_nn_functional(system_name, functional, NFinal)
+        test_non_nn_functional(system_name, functional, density_fit)
@@ -0,0 +1,46 @@
+import pytest
+
+from density_functional_approximation_dm21.constants import EPS_RHO, EPS_SIGMA
+from density_functional_approximation_dm21.derivative_check import (
+    TOLERANCE,
+    derivative_deviations,
+    grid_variables,
+)
+
+CASES = [
+    "PBE",
+    "PBE unpolarized",
+    "XAlpha",
+    "PBE OH",
+    "PBE H",
+    "XAlpha OH",
+    "XAlpha H",
+    "PBE unpolarized H2O",
+]
+
+
+@pytest.fixture(scope="module")
+def deviations():
+    return derivative_deviations(npoints=64, seed=0)
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_analytic_first_derivatives_match_autograd(deviations, name):
+    assert deviations[name][0] < TOLERANCE
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_analytic_second_derivatives_match_autograd(deviations, name):
+    assert deviations[name][1] < TOLERANCE
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_numpy_formulas_match_torch(deviations, name):
+    assert deviations[name][2] < TOLERANCE
+
+
+def test_grids_reach_the_small_density_clamps():
+    rho_a, rho_b, _, _, _ = grid_variables("OH")
+    assert (rho_a + rho_b).min() < EPS_RHO
+    _, rho_b, _, _, sigma_bb = grid_variables("H")
+    assert rho_b.max() < EPS_RHO and sigma_bb.max() < EPS_SIGMA
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from pyscf import dft, gto
+
+from density_functional_approximation_dm21.functional import NN_FUNCTIONAL
+
+# Largest deviation of the analytic second derivatives from central
+# differences of the first ones, relative to the largest second derivative
+TOLERANCE = 1e-6
+STEP = 1e-6
+
+
+def random_rho(spin, npoints=5, seed=0):
+    """PySCF MGGA rho ((5, n) or (2, 5, n)) away from the density screening"""
+    generator = np.random.default_rng(seed)
+    rho = np.empty((2, 5, npoints))
+    rho[:, 0] = generator.uniform(0.05, 0.5, (2, npoints))
+    rho[:, 1:4] = generator.uniform(-0.2, 0.2, (2, 3, npoints))
+    rho[:, 4] = generator.uniform(0.3, 1.0, (2, npoints))
+    return rho if spin == 1 else 2 * rho[0]
+
+
+@pytest.mark.parametrize("name", ["NN_PBE_star", "NN_XALPHA_99"])
+@pytest.mark.parametrize("spin", [0, 1])
+def test_fxc_matches_finite_differences(name, spin):
+    # Goes through define_xc_, so the fxc layout PySCF reads is checked too
+    mol = gto.M(atom="He", basis="sto-3g", spin=0, verbose=0)
+    mf = dft.RKS(mol) if spin == 0 else dft.UKS(mol)
+    mf.define_xc_(NN_FUNCTIONAL(name).eval_xc, "MGGA")
+    ni = mf._numint
+
+    def derivatives(rho, deriv):
+        return ni.eval_xc_eff("NN", rho, deriv=deriv, xctype="MGGA")
+
+    rho = random_rho(spin)
+    fxc = derivatives(rho, 2)[2]
+    finite_differences = np.zeros_like(fxc)
+    for index in np.ndindex(rho.shape[:-1]):
+        step = np.zeros_like(rho)
+        step[index] = STEP
+        vxc_plus = derivatives(rho + step, 1)[1]
+        vxc_minus = derivatives(rho - step, 1)[1]
+        finite_differences[(...,) + index + (slice(None),)] = (
+            vxc_plus - vxc_minus
+        ) / (2 * STEP)
+
+    deviation = np.abs(fxc - finite_differences).max() / np.abs(fxc).max()
+    assert deviation < TOLERANCE